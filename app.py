@@ -1,44 +1,144 @@
 # -*- coding: utf-8 -*-
 # -----------------------------------------------------------------------------
 # 「职场透镜」后端核心应用 (Project Lens Backend Core)
-# 版本: 35.0 - 可点击引用最终版
+# 版本: 53.0 - gevent 服务模式与共享限额
 # 描述: 1. (已实现) 修复了所有已知Bug，并升级引擎至 Gemini 2.5 Pro。
-#       2. (本次更新) 根据用户最终要求，恢复并优化了 replace_citations_with_links
+#       2. (已实现) 根据用户最终要求，恢复并优化了 replace_citations_with_links
 #          函数。它现在会生成标准的 Markdown 锚点链接 `[ID](#source-ID)`。
 #          这是实现维基百科式可点击、可跳转引用的行业标准做法，
 #          将功能指令与内容分离，交由前端进行最终渲染。
+#       3. (已实现) 后备路径的搜索与爬取改为有上限的并发执行
+#          (RESEARCH_CONCURRENCY)，来源编号保持稳定、可复现。
+#       4. (已实现) 网页爬取改用共享 keep-alive 连接池与流式下载，
+#          超过 FETCH_MAX_BYTES 即停止读取，非 HTML 内容直接跳过，
+#          并按域名限制并发 (FETCH_PER_DOMAIN_CONCURRENCY)。
+#       5. (已实现) 正文提取改为可插拔引擎 (TEXT_EXTRACTOR)，默认使用 lxml，
+#          输出与原 cleaned_text 一致，并支持去除样板内容和提前退出。
+#       6. (已实现) 网页向量化与 Pinecone 写入移出请求路径，由后台线程攒批执行，
+#          失败指数退避重试，进程退出时刷完队列。
+#       7. (已实现) 网页按重叠段落切分后批量向量化，附带公司与语言元数据；
+#          RAG 检索前先提取实体，并按公司名过滤 Pinecone 结果。
+#       8. (已实现) 用基于规范化实体与简历哈希的 SQLite 缓存 (TTL + LRU) 替换
+#          SimpleCache，缓存后端可插拔。
+#       9. (已实现) 为搜索查询、网页内容和实体提取分别增加带容量上限与命中统计的 TTL 缓存，
+#          过期网页通过条件 GET (ETag/If-Modified-Since) 重新验证。
+#       10. (已实现) 分析流程重构为事件生成器，新增 /analyze/stream 以 SSE 推送阶段进度、
+#          来源和流式生成的报告片段；客户端断开时取消未开始的爬取任务。
+#       11. (已实现) 新增 /analyze/jobs 异步任务接口，相同规范化输入的并发任务
+#          单飞合并为一次流水线执行，任务记录有界保留。
+#       12. (已实现) 单次分析共享一个端到端 Deadline，实体提取、RAG 检索、搜索、爬取和生成都从剩余预算派生超时；
+#          研究阶段达到目标来源数后只给慢请求短暂宽限；按域名熔断连续失败的站点；
+#          主模型生成超时或过载时在剩余预算内改用 GENERATION_FALLBACK_MODEL 重试。
+#       13. (已实现) 后备路径的研究数据先切成段落，用 MinHash 去掉镜像站之间的重复段落，按分析维度相关度排序，
+#          在 CONTEXT_TOKEN_BUDGET 内打包并保留 [Source ID] 标签；每次请求记录节省的 token 数。
+#       14. (已实现) 新增基于 NumPy 的进程内向量索引，镜像最近写入的段落向量，作为 Pinecone 的前置缓存；
+#          未配置 Pinecone 时独立提供 RAG 检索，可选内存映射持久化；查询向量按查询文本缓存。
+#       15. (已实现) 实体提取改为分层执行：公司名、"职位 at 公司, 地点"和带字段名的招聘信息由本地规则解析，
+#          其余输入先交给 Flash 模型并要求给出置信度，置信度不足时才调用 Gemini 2.5 Pro；各层计数见健康检查。
+#       16. (已实现) 后备研究不再固定发出约 15 个搜索：相近的分析维度用 OR 合并为 5 组查询，按历史产出排序分批发出，
+#          按缺少的来源数提高 num，来源和域名足够时提前停止；未命中缓存的搜索受单次请求预算和每日配额限制。
+#       17. (已实现) 新增 /analyze/batch 接口与 flask analyze-batch 命令：接受 JSON 数组或 JSONL，相同记录只分析一次，
+#          所有记录共享研究阶段线程池，相同的搜索和网页通过 SingleFlight 合并，查询向量批量生成，结果以 NDJSON 流式返回。
+#       18. (已实现) 各外部调用与流水线阶段用 timed_span 计时，新增 /metrics 输出 Prometheus 指标
+#          (阶段耗时、分析路径、下载字节、Prompt token、缓存与 RAG 命中率)；LOG_FORMAT=json 时日志经后台线程批量写出。
+#       19. (已实现) google.generativeai 与 pinecone 改为延迟导入，Pinecone 客户端与 GenerativeModel 实例在后台预热线程中构建并复用；
+#          新增 /readyz 就绪探针，导入、预热与第一个请求的耗时见 /readyz 与 /metrics；去掉启动时打印密钥前缀的诊断输出。
+#       20. (本次更新) Dockerfile 默认改用 gevent Worker (Gemini 走 REST)，等待外部 API 时不占用线程；设置 REDIS_URL 后
+#          速率限制 (RATELIMIT_STORAGE_URI)、分析缓存 (RedisCacheBackend) 和搜索每日配额在多 Worker、多实例间共享。
 # -----------------------------------------------------------------------------
 
+import time
+_IMPORT_STARTED = time.perf_counter()
 import os
+import sys
+import importlib
 import requests
-import google.generativeai as genai
-import time
+from requests.adapters import HTTPAdapter
 import re
+import math
+import bisect
 import json
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context, g
+import click
 from flask_cors import CORS
-from bs4 import BeautifulSoup
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
-from flask_caching import Cache
 import traceback
 import datetime
+import threading
+import queue
+import random
+import atexit
+import hashlib
+import uuid
+import sqlite3
+import tempfile
+from collections import OrderedDict
+from contextlib import closing, contextmanager, redirect_stdout
+from urllib.parse import urlparse
+from concurrent.futures import Future, ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED
 # ✨ 核心：导入Google API核心异常
-from google.api_core import exceptions as google_exceptions
 
 # --- 1. 初始化和配置 ---
 app = Flask(__name__)
 CORS(app)
 
-# 缓存配置
-cache = Cache(app, config={
-    'CACHE_TYPE': 'SimpleCache',
-    'CACHE_DEFAULT_TIMEOUT': 43200  # 12 hours in seconds
-})
+# 多 Worker / 多实例部署时，速率限制、分析缓存和 Custom Search 每日配额都需要放在共享存储中，
+# 否则每个进程各自计数，用户实际得到的额度会随进程数成倍增加。设置 REDIS_URL 后三者默认都使用 Redis。
+REDIS_URL = os.getenv("REDIS_URL", "")
+RATELIMIT_STORAGE_URI = os.getenv("RATELIMIT_STORAGE_URI", REDIS_URL or "memory://")
+
+# 共享存储不可用时退回进程内计数，而不是让请求失败
+limiter = Limiter(get_remote_address, app=app, default_limits=["5 per day"], storage_uri=RATELIMIT_STORAGE_URI, in_memory_fallback_enabled=RATELIMIT_STORAGE_URI != "memory://")
+
+_redis_clients = {}
+_redis_clients_lock = threading.Lock()
+
+def get_redis(url=None):
+    """返回按 URL 复用的 Redis 客户端 (自带连接池)；redis 包只在配置了 Redis 时才导入。"""
+    url = url or REDIS_URL
+    with _redis_clients_lock:
+        client = _redis_clients.get(url)
+        if client is None:
+            import redis
+            client = _redis_clients[url] = redis.Redis.from_url(url, socket_timeout=2, socket_connect_timeout=2, health_check_interval=30)
+        return client
+
+def gevent_patched():
+    """是否运行在 gevent Worker 中 (socket 已被 monkey patch)。"""
+    monkey = sys.modules.get('gevent.monkey')
+    return bool(monkey and monkey.is_module_patched('socket'))
 
-limiter = Limiter(get_remote_address, app=app, default_limits=["5 per day"], storage_uri="memory://")
+class LazyModule:
+    """第一次访问属性时才导入的模块代理。google.generativeai 的导入占冷启动的大部分时间，
+    改为在后台预热线程 (见 4.4) 或第一次调用时导入；对属性的赋值直接写到真实模块上。"""
 
-from pinecone import Pinecone
+    def __init__(self, name, on_load=None):
+        object.__setattr__(self, '_name', name)
+        object.__setattr__(self, '_on_load', on_load)
+        object.__setattr__(self, '_module', None)
+        object.__setattr__(self, '_lock', threading.Lock())
+
+    def load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    module = importlib.import_module(self._name)
+                    if self._on_load: self._on_load(module)
+                    object.__setattr__(self, '_module', module)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self.load(), attr, value)
+
+# gRPC 无法与 gevent 协作，gevent Worker 中 Gemini 改走 REST，调用等待期间不再占用 Worker
+GENAI_TRANSPORT = os.getenv("GENAI_TRANSPORT", "")  # 留空则 gevent 下用 rest，否则用 SDK 默认值
+genai = LazyModule('google.generativeai', on_load=lambda module: module.configure(api_key=GEMINI_API_KEY, transport=GENAI_TRANSPORT or ('rest' if gevent_patched() else None)))
+# google.api_core.exceptions 会导入 grpc，同样延迟到第一次用到异常类时
+google_exceptions = LazyModule('google.api_core.exceptions')
 
 # --- 2. API密钥配置 ---
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
@@ -50,40 +150,36 @@ PINECONE_ENVIRONMENT = os.getenv("PINECONE_ENVIRONMENT")
 API_KEYS_CONFIGURED = True
 PINECONE_INDEX = None
 
-# --- 诊断代码：打印出环境变量，看看它们在服务器上到底是什么 ---
-print("--- 环境变量诊断开始 ---")
-print(f"Cloud Run 正在使用的 PINECONE_ENVIRONMENT 是: '{os.getenv('PINECONE_ENVIRONMENT')}'")
-print(f"Cloud Run 正在使用的 PINECONE_API_KEY 的前5位是: '{str(os.getenv('PINECONE_API_KEY'))[:5]}...'")
-print("--- 环境变量诊断结束 ---")
+if not GEMINI_API_KEY:
+    print("⚠️ 警告：GEMINI_API_KEY 未设置。")
+    API_KEYS_CONFIGURED = False
+if not SEARCH_API_KEY:
+    print("⚠️ 警告：SEARCH_API_KEY 未设置。")
+    API_KEYS_CONFIGURED = False
+if not SEARCH_ENGINE_ID:
+    print("⚠️ 警告：SEARCH_ENGINE_ID 未设置。")
+    API_KEYS_CONFIGURED = False
 
-try:
-    if not GEMINI_API_KEY:
-        print("⚠️ 警告：GEMINI_API_KEY 未设置。")
-        API_KEYS_CONFIGURED = False
-    if not SEARCH_API_KEY:
-        print("⚠️ 警告：SEARCH_API_KEY 未设置。")
-        API_KEYS_CONFIGURED = False
-    if not SEARCH_ENGINE_ID:
-        print("⚠️ 警告：SEARCH_ENGINE_ID 未设置。")
-        API_KEYS_CONFIGURED = False
-    if not PINECONE_API_KEY:
-        print("⚠️ 警告：PINECONE_API_KEY 未设置。")
-        API_KEYS_CONFIGURED = False
-    if not PINECONE_ENVIRONMENT:
-        print("⚠️ 警告：PINECONE_ENVIRONMENT 未设置。")
-        API_KEYS_CONFIGURED = False
-
-    if API_KEYS_CONFIGURED:
-        genai.configure(api_key=GEMINI_API_KEY)
+if API_KEYS_CONFIGURED:
+    print("✅ API密钥配置成功！服务已准备就绪。")
+else:
+    print("⚠️ 警告：一个或多个API密钥未设置。服务将以受限模式运行，/analyze 端点将不可用。")
+
+def init_pinecone():
+    """Pinecone 是可选的：未配置或连接失败时只使用进程内的本地向量索引 (见 6.4)。
+    客户端在启动预热 (见 4.4) 中构建，预热完成前的请求只查询本地索引。"""
+    global PINECONE_INDEX
+    if not (PINECONE_API_KEY and PINECONE_ENVIRONMENT):
+        log_event('pinecone_disabled', "⚠️ 警告：PINECONE_API_KEY 或 PINECONE_ENVIRONMENT 未设置，将只使用本地向量索引。", level='warning')
+        return
+    try:
+        from pinecone import Pinecone
         pinecone_client = Pinecone(api_key=PINECONE_API_KEY, environment=PINECONE_ENVIRONMENT)
         index_name = 'project-lens-data'
         PINECONE_INDEX = pinecone_client.Index(index_name)
-        print("✅ API密钥与Pinecone配置成功！服务已准备就绪。")
-    else:
-        print("⚠️ 警告：一个或多个API密钥或Pinecone环境变量未设置。服务将以受限模式运行，/analyze 端点将不可用。")
-except Exception as e:
-    API_KEYS_CONFIGURED = False
-    print(f"❌ API密钥或Pinecone配置失败: {e}")
+        log_event('pinecone_ready', "✅ Pinecone配置成功！", index=index_name)
+    except Exception as e:
+        log_event('pinecone_failed', f"❌ Pinecone配置失败: {e}，将只使用本地向量索引。", level='error', error=str(e))
 
 # --- 3. 错误响应辅助函数 ---
 def make_error_response(error_type, message, status_code):
@@ -108,12 +204,511 @@ def get_rate_limit_message(request):
         pass
     return messages.get(lang_code, messages['en'])
 
-# --- 5. 智能提取实体 ---
-def extract_entities_with_ai(text_blob):
-    print("🤖 启动AI实体提取程序 (模型: Gemini 2.5 Pro)...")
+# --- 4.1 阶段结果缓存 ---
+# 即使整份报告未命中缓存，搜索查询、网页内容和实体提取结果在请求之间也高度重复。
+# 每个阶段各有一个独立的进程内 TTL 缓存，按字节数限制容量 (LRU 淘汰)，并统计命中率。
+class StageCache:
+    def __init__(self, name, max_bytes, ttl):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = self.misses = self.evictions = 0
+        self._entries = OrderedDict()  # key -> (expires_at, size, value)
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.time():
+                if entry is not None: self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def set(self, key, value):
+        size = len(json.dumps(value, ensure_ascii=False).encode('utf-8'))
+        if size > self.max_bytes: return
+        with self._lock:
+            if key in self._entries: self._remove(key)
+            self._entries[key] = (time.time() + self.ttl, size, value)
+            self._size += size
+            while self._size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def __contains__(self, key):
+        # 只检查是否存在且未过期，不计入命中率，也不改变 LRU 顺序
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and entry[0] >= time.time()
+
+    def _remove(self, key):
+        self._size -= self._entries.pop(key)[1]
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return { 'entries': len(self._entries), 'bytes': self._size, 'max_bytes': self.max_bytes, 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0 }
+
+SEARCH_CACHE = StageCache('search', int(os.getenv("SEARCH_CACHE_MAX_BYTES", str(8 * 1024 * 1024))), int(os.getenv("SEARCH_CACHE_TTL", "21600")))
+PAGE_CACHE = StageCache('page', int(os.getenv("PAGE_CACHE_MAX_BYTES", str(64 * 1024 * 1024))), int(os.getenv("PAGE_CACHE_TTL", "86400")))
+PAGE_CACHE_FRESH_SECONDS = int(os.getenv("PAGE_CACHE_FRESH_SECONDS", "3600"))  # 超过此时间的网页用条件 GET 重新验证
+ENTITY_CACHE = StageCache('entity', int(os.getenv("ENTITY_CACHE_MAX_BYTES", str(4 * 1024 * 1024))), int(os.getenv("ENTITY_CACHE_TTL", "86400")))
+STAGE_CACHES = [SEARCH_CACHE, PAGE_CACHE, ENTITY_CACHE]
+
+class SingleFlight:
+    """同一个键同时只执行一次：并发的相同调用等待第一个调用的结果 (或异常)，而不是各自访问上游。"""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._calls[key] = future
+        if not leader: return future.result()
+        try:
+            result = fn(*args, **kwargs)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+# 缓存只能在结果返回之后起作用；批量分析中多家公司同时命中相同查询或网页时由它们合并请求
+_search_flights = SingleFlight()
+_scrape_flights = SingleFlight()
+
+# --- 4.2 请求时间预算与熔断 ---
+# 每个分析请求有一个总时间预算 (ANALYSIS_DEADLINE_SECONDS)，各阶段从剩余预算中切出自己的份额，
+# 每次外部调用的超时都不超过所在阶段的剩余时间，因此单个请求的耗时有可预期的上限。
+# 反复超时的域名会被熔断一段时间，期间直接跳过，不再每次白等 FETCH_TIMEOUT 秒。
+ANALYSIS_DEADLINE_SECONDS = float(os.getenv("ANALYSIS_DEADLINE_SECONDS", "120"))
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "3"))
+BREAKER_COOLDOWN_SECONDS = float(os.getenv("BREAKER_COOLDOWN_SECONDS", "300"))
+
+class Deadline:
+    def __init__(self, seconds, parent=None):
+        self.expires_at = time.monotonic() + max(0.0, seconds)
+        if parent is not None: self.expires_at = min(self.expires_at, parent.expires_at)
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def timeout(self, cap=None, floor=0.5):
+        """单次调用的超时：不超过 cap，也不超过剩余预算 (但至少 floor 秒，避免传入 0)。"""
+        remaining = self.remaining() if cap is None else min(cap, self.remaining())
+        return max(floor, remaining)
+
+    def slice(self, fraction, cap=None):
+        """从剩余预算中切出一个子阶段的预算。"""
+        seconds = self.remaining() * fraction
+        return Deadline(seconds if cap is None else min(cap, seconds), parent=self)
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    pass
+
+class CircuitBreaker:
+    """按域名统计连续失败次数，达到阈值后熔断 cooldown 秒；冷却结束后进入半开状态，只放行一次试探请求。"""
+    def __init__(self, failure_threshold=BREAKER_FAILURE_THRESHOLD, cooldown=BREAKER_COOLDOWN_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._failures = {}    # host -> 连续失败次数
+        self._open_until = {}  # host -> 熔断结束时间
+        self._lock = threading.Lock()
+
+    def allow(self, host):
+        with self._lock:
+            open_until = self._open_until.get(host)
+            if open_until is None: return True
+            now = time.monotonic()
+            if now < open_until: return False
+            # 半开状态：只放行这一次试探请求，其余请求在试探结果返回前继续被拒绝；
+            # 试探成功则关闭熔断，失败则立即重新熔断。试探在 cooldown 秒内没有结果时再放行下一次。
+            self._open_until[host] = now + self.cooldown
+            self._failures[host] = self.failure_threshold - 1
+            return True
+
+    def record_success(self, host):
+        with self._lock:
+            self._failures.pop(host, None)
+            self._open_until.pop(host, None)
+
+    def record_failure(self, host):
+        with self._lock:
+            failures = self._failures.get(host, 0) + 1
+            self._failures[host] = failures
+            if failures >= self.failure_threshold:
+                self._open_until[host] = time.monotonic() + self.cooldown
+                log_event('circuit_open', f"🔌 域名 {host} 连续失败 {failures} 次，熔断 {self.cooldown:.0f} 秒。", level='warning', host=host, failures=failures)
+
+    def open_hosts(self):
+        with self._lock:
+            now = time.monotonic()
+            return sorted(host for host, until in self._open_until.items() if until > now)
+
+DOMAIN_BREAKER = CircuitBreaker()
+
+TIMEOUT_GUARD_THREADS = int(os.getenv("TIMEOUT_GUARD_THREADS", "0"))  # 0 表示与 Worker 的并发请求数相同
+
+class TimeoutGuard:
+    """给没有超时参数的 SDK 调用 (如 Pinecone 查询) 加上超时；超时抛出 TimeoutError。
+    每个外部依赖使用独立的线程池，一个依赖变慢不会占满其他依赖的线程。线程池大小默认等于 Worker 的并发请求数
+    (gevent 下为 GUNICORN_WORKER_CONNECTIONS，gthread 下为 GUNICORN_THREADS)，每个请求最多占用一个线程，正常情况下不需要排队。
+    超时从调用真正开始运行时计时；线程池满时最多再排队 timeout 秒，仍未开始则放弃且不再执行。
+    限制：超时的调用无法中断，会继续占用线程直到 SDK 返回，因此持续变慢的依赖最终会让自己的线程池排队。"""
+    def __init__(self, name, max_workers=None):
+        self.name = name
+        if not max_workers:
+            max_workers = TIMEOUT_GUARD_THREADS or int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "500") if gevent_patched() else os.getenv("GUNICORN_THREADS", "8"))
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f'timeout-guard-{name}')
+
+    def call(self, fn, timeout, *args, **kwargs):
+        started = threading.Event()
+        def run():
+            started.set()
+            return fn(*args, **kwargs)
+        future = self._executor.submit(run)
+        if not started.wait(timeout) and future.cancel():
+            raise TimeoutError(f"{self.name}: 排队 {timeout:.1f} 秒仍没有空闲线程。")
+        return future.result(timeout=timeout)
+
+PINECONE_GUARD = TimeoutGuard('pinecone')
+
+# --- 4.3 指标与结构化日志 ---
+# timed_span 记录每个外部调用和阶段的耗时 (Prometheus 直方图，由 /metrics 输出)。
+# 热路径日志统一走 log_event：LOG_FORMAT=text (默认) 时与原先的 print 相同；
+# LOG_FORMAT=json 时只把记录放入有界队列，由后台线程批量写成 JSON lines，请求线程不等待 I/O，
+# 同时每个 timed_span 也会写一条 span 记录。
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()  # text | json
+LOG_QUEUE_MAX = int(os.getenv("LOG_QUEUE_MAX", "10000"))
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+TOKEN_BUCKETS = (500, 1000, 2000, 4000, 8000, 16000, 32000, 64000, 128000)
+
+METRICS_REGISTRY = []
+
+def _escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs: return ''
+    return '{' + ','.join(f'{name}="{_escape_label_value(value)}"' for name, value in pairs) + '}'
+
+class MetricCounter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name, self.documentation, self.labelnames = name, documentation, tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        METRICS_REGISTRY.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def total(self, **labels):
+        """返回与给定标签匹配的所有序列之和。"""
+        wanted = [(self.labelnames.index(name), value) for name, value in labels.items()]
+        with self._lock:
+            return sum(value for key, value in self._values.items() if all(key[i] == expected for i, expected in wanted))
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            lines += [f"{self.name}{_format_labels(self.labelnames, key)} {value}" for key, value in sorted(self._values.items())]
+        return lines
+
+class MetricHistogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name, self.documentation, self.labelnames, self.buckets = name, documentation, tuple(labelnames), tuple(buckets)
+        self._values = {}  # 标签 -> [各桶计数 (非累计), 总和, 次数]
+        self._lock = threading.Lock()
+        METRICS_REGISTRY.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.setdefault(key, [[0] * (len(self.buckets) + 1), 0.0, 0])
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += bucket_count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', le)])} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}")
+                lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+STAGE_DURATION = MetricHistogram('project_lens_stage_duration_seconds', 'Latency of external calls and pipeline stages.', ('stage', 'outcome'))
+ANALYSIS_DURATION = MetricHistogram('project_lens_analysis_duration_seconds', 'End-to-end analysis latency by path.', ('path', 'outcome'))
+ANALYSES_TOTAL = MetricCounter('project_lens_analyses_total', 'Finished analyses by path (cache, rag, fallback, none) and outcome.', ('path', 'outcome'))
+FETCH_BYTES = MetricCounter('project_lens_fetch_bytes_total', 'Bytes downloaded by the page fetcher.')
+FETCH_PAGES = MetricCounter('project_lens_fetch_pages_total', 'Page fetches by outcome.', ('outcome',))
+PROMPT_TOKENS = MetricHistogram('project_lens_prompt_tokens', 'Estimated tokens in generation prompts.', ('path',), buckets=TOKEN_BUCKETS)
+CONTEXT_TOKENS_SAVED = MetricCounter('project_lens_context_tokens_saved_total', 'Estimated research tokens removed by the context packer.')
+LOG_RECORDS_DROPPED = MetricCounter('project_lens_log_records_dropped_total', 'JSON log records dropped because the log queue was full.')
+
+_log_queue = queue.Queue(maxsize=LOG_QUEUE_MAX)
+_log_writer_thread = None
+_log_writer_lock = threading.Lock()
+
+def log_event(event, message, level='info', exc_info=False, **fields):
+    """热路径日志。text 模式下直接 print；json 模式下入队后立即返回，队列满时丢弃并计数。"""
+    if LOG_FORMAT != 'json':
+        print(message)
+        if exc_info: print(traceback.format_exc())
+        return
+    record = {'ts': time.time(), 'level': level, 'event': event, 'message': message, 'thread': threading.current_thread().name, **fields}
+    if exc_info: record['traceback'] = traceback.format_exc()
+    _ensure_log_writer_started()
+    try:
+        _log_queue.put_nowait(record)
+    except queue.Full:
+        LOG_RECORDS_DROPPED.inc()
+
+def _ensure_log_writer_started():
+    global _log_writer_thread
+    if _log_writer_thread and _log_writer_thread.is_alive(): return
+    with _log_writer_lock:
+        if _log_writer_thread and _log_writer_thread.is_alive(): return
+        _log_writer_thread = threading.Thread(target=_log_writer_loop, name='log-writer', daemon=True)
+        _log_writer_thread.start()
+
+def _write_log_records(records):
+    lines = []
+    for record in records:
+        record['ts'] = datetime.datetime.utcfromtimestamp(record['ts']).isoformat(timespec='milliseconds') + "Z"
+        lines.append(json.dumps(record, ensure_ascii=False, default=str))
+    sys.stdout.write('\n'.join(lines) + '\n')
+    sys.stdout.flush()
+
+def _log_writer_loop():
+    while True:
+        records = [_log_queue.get()]
+        # 一次取走队列中已有的记录，合并成一次写入
+        while len(records) < 500:
+            try:
+                records.append(_log_queue.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            _write_log_records(records)
+        except Exception:
+            pass
+
+def flush_logs():
+    """同步写出队列中剩余的日志记录 (进程退出时调用)。"""
+    records = []
+    while True:
+        try:
+            records.append(_log_queue.get_nowait())
+        except queue.Empty:
+            break
+    if records: _write_log_records(records)
+
+atexit.register(flush_logs)
+
+class Span:
+    """timed_span 产出的对象：调用方可以设置 outcome 覆盖默认结果 (例如 rejected / not_modified)。"""
+    def __init__(self):
+        self.outcome = None
+
+@contextmanager
+def timed_span(stage, **fields):
+    """记录一段代码的耗时与结果 (ok / error / cancelled，或调用方设置的 span.outcome)；也可以作为装饰器使用。"""
+    started, outcome, span = time.perf_counter(), 'ok', Span()
     try:
-        model = genai.GenerativeModel('models/gemini-2.5-pro')
-        prompt = f"""From the text below, extract the company name, job title, and location. Respond with a JSON object: {{"company_name": "...", "job_title": "...", "location": "..."}}.
+        yield span
+    except GeneratorExit:
+        outcome = 'cancelled'
+        raise
+    except BaseException:
+        outcome = 'error'
+        raise
+    finally:
+        if span.outcome and outcome != 'cancelled': outcome = span.outcome
+        duration = time.perf_counter() - started
+        STAGE_DURATION.observe(duration, stage=stage, outcome=outcome)
+        if LOG_FORMAT == 'json': log_event('span', f"{stage} {outcome} in {duration * 1000:.1f} ms", stage=stage, outcome=outcome, duration_ms=round(duration * 1000, 2), **fields)
+
+def record_span_outcome(stage, outcome):
+    """没有发出网络请求的结果 (缓存命中、配额用完) 只计数，耗时记为 0，不与真实请求的耗时混在一起。"""
+    STAGE_DURATION.observe(0.0, stage=stage, outcome=outcome)
+
+def render_metrics():
+    """Prometheus 文本格式：已注册的计数器与直方图，加上抓取时从各组件读取的缓存、配额和队列状态。"""
+    lines = []
+    for metric in METRICS_REGISTRY: lines += metric.render()
+
+    def gauge(name, documentation, samples, metric_type='gauge'):
+        lines.extend([f"# HELP {name} {documentation}", f"# TYPE {name} {metric_type}"])
+        lines.extend(f"{name}{_format_labels(tuple(labels), tuple(labels.values()))} {value}" for labels, value in samples)
+
+    cache_stats = [(stage_cache.name, stage_cache.stats()) for stage_cache in STAGE_CACHES]
+    gauge('project_lens_cache_hits_total', 'Stage cache hits.', [({'cache': name}, stats['hits']) for name, stats in cache_stats], 'counter')
+    gauge('project_lens_cache_misses_total', 'Stage cache misses.', [({'cache': name}, stats['misses']) for name, stats in cache_stats], 'counter')
+    gauge('project_lens_cache_hit_ratio', 'Stage cache hit ratio since start.', [({'cache': name}, stats['hit_rate']) for name, stats in cache_stats])
+    gauge('project_lens_cache_bytes', 'Bytes held by each stage cache.', [({'cache': name}, stats['bytes']) for name, stats in cache_stats])
+    rag, fallback = ANALYSES_TOTAL.total(path='rag', outcome='ok'), ANALYSES_TOTAL.total(path='fallback', outcome='ok')
+    gauge('project_lens_rag_hit_ratio', 'Share of generated (non-cached) analyses answered from the vector index rather than web research.', [({}, round(rag / (rag + fallback), 4) if rag + fallback else 0)])
+    gauge('project_lens_search_quota_used', 'Custom Search calls made today (UTC).', [({}, CSE_QUOTA.stats()['used_today'])])
+    gauge('project_lens_index_queue_size', 'Pages waiting for background embedding.', [({}, _index_queue.qsize())])
+    gauge('project_lens_log_queue_size', 'JSON log records waiting to be written.', [({}, _log_queue.qsize())])
+    if LOCAL_VECTOR_INDEX: gauge('project_lens_local_index_vectors', 'Vectors held by the local vector index.', [({}, LOCAL_VECTOR_INDEX.stats()['vectors'])])
+    gauge('project_lens_ready', 'Whether the startup warm-up has finished.', [({}, int(WARMUP_DONE.is_set()))])
+    gauge('project_lens_startup_seconds', 'Module import, warm-up and first-request latency.', [({'phase': phase}, STARTUP_STATE[f"{phase}_seconds"]) for phase in ('import', 'warmup', 'first_request') if STARTUP_STATE[f"{phase}_seconds"] is not None])
+    return '\n'.join(lines) + '\n'
+
+# --- 4.4 启动预热与就绪探针 ---
+# 冷启动时模块导入只做轻量工作：google.generativeai 和 pinecone 改为延迟导入，
+# Pinecone 客户端与 GenerativeModel 实例在后台预热线程中构建，HTTP 端口可以更早开始接受请求。
+# GenerativeModel 按模型名缓存复用，不再每次调用都重新创建。
+# /readyz 在预热完成前返回 503；导入耗时、预热耗时和第一个请求的耗时见 /readyz 与 /metrics。
+STARTUP_WARMUP = os.getenv("STARTUP_WARMUP", "background").lower()  # background | sync
+
+MODEL_CACHE = {}
+_model_cache_lock = threading.Lock()
+
+STARTUP_STATE = {'import_seconds': None, 'warmup_seconds': None, 'warmup_steps': {}, 'warmup_error': None, 'first_request_seconds': None, 'first_request_after_start_seconds': None}
+WARMUP_DONE = threading.Event()
+_first_request_lock = threading.Lock()
+
+def get_model(model_name):
+    """返回按模型名缓存的 GenerativeModel 实例。"""
+    model = MODEL_CACHE.get(model_name)
+    if model is None:
+        with _model_cache_lock:
+            model = MODEL_CACHE.get(model_name)
+            if model is None: model = MODEL_CACHE[model_name] = genai.GenerativeModel(model_name)
+    return model
+
+def warm_up():
+    """按顺序执行预热步骤并记录各步耗时；单个步骤失败不影响其余步骤，相应组件会在第一次使用时再初始化。"""
+    started = time.perf_counter()
+    steps = [
+        ('genai', genai.load),
+        ('pinecone', init_pinecone),
+        ('models', lambda: [get_model(name) for name in (ENTITY_FAST_MODEL, ENTITY_PRO_MODEL, GENERATION_MODEL, GENERATION_FALLBACK_MODEL) if name]),
+        ('text_extractor', lambda: extract_text(b'<html><body><p>warm-up</p></body></html>')),
+    ]
+    for name, step in steps:
+        step_started = time.perf_counter()
+        try:
+            step()
+        except Exception as e:
+            STARTUP_STATE['warmup_error'] = f"{name}: {type(e).__name__}: {e}"
+            log_event('warmup_step_failed', f"⚠️ 预热步骤 {name} 失败: {e}", level='warning', step=name, error=str(e))
+        STARTUP_STATE['warmup_steps'][name] = round(time.perf_counter() - step_started, 4)
+    STARTUP_STATE['warmup_seconds'] = round(time.perf_counter() - started, 4)
+    WARMUP_DONE.set()
+    log_event('warmup_done', f"🔥 预热完成，用时 {STARTUP_STATE['warmup_seconds']:.2f} 秒: {STARTUP_STATE['warmup_steps']}", warmup_seconds=STARTUP_STATE['warmup_seconds'], steps=STARTUP_STATE['warmup_steps'])
+
+def start_warm_up():
+    STARTUP_STATE['import_seconds'] = round(time.perf_counter() - _IMPORT_STARTED, 4)
+    log_event('import_done', f"🚀 模块导入用时 {STARTUP_STATE['import_seconds']:.2f} 秒，预热模式: {STARTUP_WARMUP}", import_seconds=STARTUP_STATE['import_seconds'], mode=STARTUP_WARMUP)
+    if STARTUP_WARMUP == 'sync':
+        warm_up()
+    else:
+        threading.Thread(target=warm_up, name='startup-warmup', daemon=True).start()
+
+def record_first_request(duration):
+    """记录进程处理的第一个请求的耗时，以及从开始导入到它完成的总时长。"""
+    if STARTUP_STATE['first_request_seconds'] is not None: return
+    with _first_request_lock:
+        if STARTUP_STATE['first_request_seconds'] is not None: return
+        STARTUP_STATE['first_request_seconds'] = round(duration, 4)
+        STARTUP_STATE['first_request_after_start_seconds'] = round(time.perf_counter() - _IMPORT_STARTED, 4)
+    log_event('first_request', f"⏱️ 第一个请求用时 {duration:.2f} 秒 (距开始导入 {STARTUP_STATE['first_request_after_start_seconds']:.2f} 秒)", first_request_seconds=STARTUP_STATE['first_request_seconds'], after_start_seconds=STARTUP_STATE['first_request_after_start_seconds'])
+
+# --- 5. 智能提取实体 ---
+# 分层提取：短输入和常见的招聘信息格式先用本地规则解析；规则无法确定时交给更快的 Flash 模型，
+# 模型自评置信度过低 (或输入过长) 时才调用 Gemini 2.5 Pro。结果按输入哈希缓存，
+# ENTITY_TIER_COUNTS 统计每一层处理了多少请求 (见健康检查接口)。
+ENTITY_FAST_MODEL = os.getenv("ENTITY_FAST_MODEL", "models/gemini-2.5-flash")  # 留空则跳过快速模型层
+ENTITY_PRO_MODEL = 'models/gemini-2.5-pro'
+ENTITY_RULES_MAX_CHARS = int(os.getenv("ENTITY_RULES_MAX_CHARS", "300"))
+ENTITY_FAST_MAX_CHARS = int(os.getenv("ENTITY_FAST_MAX_CHARS", "4000"))
+ENTITY_CONFIDENCE_THRESHOLD = float(os.getenv("ENTITY_CONFIDENCE_THRESHOLD", "0.7"))
+ENTITY_FAST_BUDGET_SHARE = float(os.getenv("ENTITY_FAST_BUDGET_SHARE", "0.4"))  # 快速模型最多使用的实体阶段预算比例，其余留给 Pro
+
+ENTITY_TIER_COUNTS = {'cache': 0, 'rules': 0, 'fast_model': 0, 'pro_model': 0}
+_entity_tier_lock = threading.Lock()
+
+_JOB_TITLE_WORDS = re.compile(r'\b(engineer|developer|programmer|manager|analyst|designer|scientist|researcher|architect|consultant|specialist|director|lead|intern|associate|administrator|coordinator|technician|officer|accountant|recruiter|representative|assistant|executive|head|vp|sre|devops)s?\b|工程师|开发|经理|分析师|设计师|科学家|研究员|架构师|顾问|专员|总监|主管|实习生|助理|运营|产品|销售|会计', re.I)
+_LABELLED_FIELDS = {
+    'company_name': re.compile(r'^\s*(?:company(?:\s+name)?|employer|organi[sz]ation|公司(?:名称)?|企业|雇主)\s*[:：]\s*(.+)$', re.I | re.M),
+    'job_title': re.compile(r'^\s*(?:job\s+title|position|role|title|职位(?:名称)?|岗位|职务)\s*[:：]\s*(.+)$', re.I | re.M),
+    'location': re.compile(r'^\s*(?:location|job\s+location|city|office|(?:工作)?地点|城市)\s*[:：]\s*(.+)$', re.I | re.M),
+}
+# "Senior Engineer at Acme Corp, Berlin" / "Engineer @ Acme (Remote)" / "Engineer at Acme - London"
+_TITLE_AT_COMPANY = re.compile(r'^(?P<title>[^,@\n]{2,80}?)\s+(?:at|@)\s+(?P<company>[^,()\n]{1,80}?)(?:\s*(?:,|\s-\s|\||\()\s*(?P<location>[^()\n]{2,60}?)\)?)?\s*$', re.I)
+_PLAIN_NAME = re.compile(r"^[\w&.'’()\- ]{1,60}$")
+# 出现这些词的短句是提问或描述 ("red flags for Tesla")，不是公司名
+_NOT_A_NAME = re.compile(r"\b(?:for|about|is|are|was|how|what|why|when|where|which|who|should|can|any|flags?|reviews?|worth|joining|vs|my)\b|[?？]|怎么样|如何|靠谱|值得|评价|吗|呢", re.I)
+_COMPANY_SUFFIX = re.compile(r"\b(?:inc|corp(?:oration)?|co|company|ltd|llc|plc|gmbh|ag|sa|group|holdings|technologies|labs)\.?$|(?:公司|集团|科技)$", re.I)
+_NAME_CONNECTORS = {'&', 'and', 'of', 'the', 'de', 'und'}
+
+def _record_entity_tier(tier):
+    with _entity_tier_lock:
+        ENTITY_TIER_COUNTS[tier] += 1
+
+def _looks_like_company_name(name):
+    """较短、不含职位关键词和提问用词，多词时英文单词首字母大写。"""
+    words = name.split()
+    if not words or not _PLAIN_NAME.match(name) or len(words) > 6 or _JOB_TITLE_WORDS.search(name) or _NOT_A_NAME.search(name):
+        return False
+    return len(words) == 1 or all(word[0].isupper() or not word[0].isascii() or not word[0].isalpha() or word.lower() in _NAME_CONNECTORS for word in words)
+
+def parse_entities_with_rules(text_blob):
+    """本地规则解析，返回 (company, job_title, location, confidence)；无法解析时返回 None。"""
+    text = text_blob.strip()
+    if not text or len(text) > ENTITY_RULES_MAX_CHARS * 10: return None
+    # 1. 带字段名的招聘信息 (Company: ... / 公司：...)
+    labelled = {field: (pattern.search(text).group(1).strip() if pattern.search(text) else '') for field, pattern in _LABELLED_FIELDS.items()}
+    if labelled['company_name']:
+        return labelled['company_name'], labelled['job_title'], labelled['location'], 0.95
+    if len(text) > ENTITY_RULES_MAX_CHARS or '\n' in text: return None
+    # 提问句 ("What is it like to be an engineer at Google?") 不由规则解析，交给模型
+    if _NOT_A_NAME.search(text): return None
+    # 2. 单行的 "职位 at 公司, 地点"，公司后的 " in 地点" 也拆到 location
+    match = _TITLE_AT_COMPANY.match(text)
+    if match and _JOB_TITLE_WORDS.search(match.group('title')):
+        company, location = match.group('company').strip(), (match.group('location') or '').strip()
+        in_place = re.match(r'^(.+?)\s+in\s+(.+)$', company, re.I)
+        if in_place: company, location = in_place.group(1).strip(), ', '.join(filter(None, [in_place.group(2).strip(), location]))
+        if not _looks_like_company_name(company): return None
+        return company, match.group('title').strip(), location, 0.9
+    # 3. 只输入了公司名 (不含分隔符)
+    if re.search(r'\s(?:at|in)\s|@', text, re.I) or not _looks_like_company_name(text): return None
+    # 单个词或带公司后缀的名称直接采用；"Tesla Berlin" 这类多词名称可能混有地点，置信度低于阈值交给模型确认
+    return text, '', '', 0.85 if len(text.split()) == 1 or _COMPANY_SUFFIX.search(text) else 0.6
+
+def _extract_entities_with_model(model_name, text_blob, timeout, with_confidence):
+    confidence_instruction = ' Also include "confidence": a number from 0 to 1 describing how sure you are that company_name is correct.' if with_confidence else ''
+    model = get_model(model_name)
+    prompt = f"""From the text below, extract the company name, job title, and location. Respond with a JSON object: {{"company_name": "...", "job_title": "...", "location": "..."}}.{confidence_instruction}
 If a value isn't found, return an empty string "".
 
 Text:
@@ -121,68 +716,1068 @@ Text:
 {text_blob}
 ---
 """
-        response = model.generate_content(prompt, generation_config=genai.GenerationConfig(response_mime_type="application/json"))
-        if not response.parts: print(f"--- 实体提取AI响应被阻止: {response.prompt_feedback} ---"); return text_blob, "", ""
-        entities = json.loads(response.text)
-        company, job_title, location = entities.get("company_name", ""), entities.get("job_title", ""), entities.get("location", "")
-        print(f"✅ AI提取成功: 公司='{company}', 职位='{job_title}', 地点='{location}'")
-        return company if company else text_blob, job_title, location
-    except Exception as e:
-        raise e
+    with timed_span('entity_' + model_name.rsplit('/', 1)[-1]):
+        response = model.generate_content(prompt, generation_config=genai.GenerationConfig(response_mime_type="application/json"), request_options={'timeout': timeout} if timeout else None)
+    if not response.parts:
+        log_event('entity_extraction_blocked', f"--- 实体提取AI响应被阻止: {response.prompt_feedback} ---", level='warning')
+        return None
+    entities = json.loads(response.text)
+    try:
+        confidence = float(entities.get("confidence", 0))
+    except (TypeError, ValueError):
+        confidence = 0.0
+    return entities.get("company_name", ""), entities.get("job_title", ""), entities.get("location", ""), confidence
+
+@timed_span('entity_extraction')
+def extract_entities_with_ai(text_blob, deadline=None):
+    """deadline 是整个实体阶段的预算：快速模型只用其中 ENTITY_FAST_BUDGET_SHARE，Pro 使用剩余部分，
+    两层模型调用加起来不会超过这一预算。"""
+    cache_key = hashlib.sha256(text_blob.encode('utf-8')).hexdigest()
+    cached_entities = ENTITY_CACHE.get(cache_key)
+    if cached_entities:
+        log_event('entity_cache_hit', f"⚡ 命中实体提取缓存: 公司='{cached_entities[0]}'", company=cached_entities[0])
+        _record_entity_tier('cache')
+        return tuple(cached_entities)
+
+    result, tier = parse_entities_with_rules(text_blob), 'rules'
+    if result and result[3] >= ENTITY_CONFIDENCE_THRESHOLD:
+        log_event('entity_rules', f"⚡ 规则提取成功: 公司='{result[0]}', 职位='{result[1]}', 地点='{result[2]}'", company=result[0], job_title=result[1], location=result[2])
+    else:
+        result, fast_result = None, None
+        if ENTITY_FAST_MODEL and len(text_blob) <= ENTITY_FAST_MAX_CHARS:
+            log_event('entity_model_start', f"🤖 启动AI实体提取程序 (模型: {ENTITY_FAST_MODEL})...", model=ENTITY_FAST_MODEL)
+            try:
+                fast_timeout = deadline.timeout(deadline.remaining() * ENTITY_FAST_BUDGET_SHARE) if deadline else None
+                result, tier = _extract_entities_with_model(ENTITY_FAST_MODEL, text_blob, fast_timeout, with_confidence=True), 'fast_model'
+            except Exception as e:
+                log_event('entity_fast_model_failed', f"⚠️ 快速模型实体提取失败: {e}，改用 Gemini 2.5 Pro。", level='warning', error=str(e))
+            if result and (not result[0] or result[3] < ENTITY_CONFIDENCE_THRESHOLD):
+                log_event('entity_fast_model_low_confidence', f"⚠️ 快速模型置信度不足 ({result[3]:.2f})，改用 Gemini 2.5 Pro。", confidence=result[3])
+                fast_result, result = (result if result[0] else None), None
+        if result is None and deadline and deadline.expired():
+            # 预算已用完：有快速模型的结果就用它，否则按超时处理
+            if fast_result is None: raise google_exceptions.DeadlineExceeded("Entity extraction ran out of time before the Gemini 2.5 Pro tier.")
+            log_event('entity_pro_skipped', "⏱️ 实体提取预算已用完，跳过 Gemini 2.5 Pro，使用快速模型的结果。", level='warning', confidence=fast_result[3])
+            result = fast_result
+        if result is None:
+            log_event('entity_model_start', "🤖 启动AI实体提取程序 (模型: Gemini 2.5 Pro)...", model=ENTITY_PRO_MODEL)
+            result, tier = _extract_entities_with_model(ENTITY_PRO_MODEL, text_blob, deadline.timeout() if deadline else None, with_confidence=False), 'pro_model'
+            if result is None:
+                _record_entity_tier('pro_model')
+                return text_blob, "", ""
+        log_event('entity_model_done', f"✅ AI提取成功: 公司='{result[0]}', 职位='{result[1]}', 地点='{result[2]}'", tier=tier, company=result[0], job_title=result[1], location=result[2])
+
+    company, job_title, location = result[:3]
+    entities = (company if company else text_blob, job_title, location)
+    _record_entity_tier(tier)
+    ENTITY_CACHE.set(cache_key, list(entities))
+    return entities
 
 # --- 6. Google搜索 ---
-def perform_google_search(query, api_key, cse_id, num_results=2):
+def search_cache_key(query, num_results, cse_id=None):
+    return f"{cse_id or SEARCH_ENGINE_ID}|{num_results}|{query}"
+
+def perform_google_search(query, api_key, cse_id, num_results=2, timeout=15):
+    return _search_flights.do(search_cache_key(query, num_results, cse_id), _perform_google_search, query, api_key, cse_id, num_results, timeout)
+
+def _perform_google_search(query, api_key, cse_id, num_results, timeout):
     url = "https://www.googleapis.com/customsearch/v1"
     params = {'key': api_key, 'cx': cse_id, 'q': query, 'num': num_results}
-    print(f"🔍 正在执行Google搜索: 查询='{query}', 参数={params})") # Debug log
+    cache_key = search_cache_key(query, num_results, cse_id)
+    cached_results = SEARCH_CACHE.get(cache_key)
+    if cached_results:
+        record_span_outcome('search', 'cache_hit')
+        return cached_results[0], cached_results[1]
+    # 只有真正发往 CSE 的请求才消耗每日配额，缓存命中不计
+    if not CSE_QUOTA.try_acquire():
+        record_span_outcome('search', 'quota_exhausted')
+        log_event('search_quota_exhausted', f"⚠️ 今日 Custom Search 配额 ({CSE_DAILY_QUOTA} 次) 已用完，跳过查询='{query}'", level='warning', query=query)
+        return [], []
+    log_event('search_request', f"🔍 正在执行Google搜索: 查询='{query}', num={num_results}", level='debug', query=query, num=num_results)
     try:
-        response = requests.get(url, params=params, timeout=15)
-        response.raise_for_status()
-        search_results = response.json()
+        with timed_span('search'):
+            response = requests.get(url, params=params, timeout=timeout)
+            response.raise_for_status()
+            search_results = response.json()
         items_count = len(search_results.get('items', []))
         first_item_title = search_results.get('items', [{}])[0].get('title', '无标题') if items_count > 0 else '无结果'
-        print(f"✅ Google搜索API响应: 查询='{query}', 结果数={items_count}, 首个结果标题='{first_item_title}'") # Debug log
+        log_event('search_response', f"✅ Google搜索API响应: 查询='{query}', 结果数={items_count}, 首个结果标题='{first_item_title}'", query=query, results=items_count)
 
         if 'items' not in search_results:
-            print(f"⚠️ Google搜索成功但没有结果: 查询='{query}")
+            log_event('search_empty', f"⚠️ Google搜索成功但没有结果: 查询='{query}", level='warning', query=query)
+            SEARCH_CACHE.set(cache_key, [[], []])
             return [], []
         snippets = [item.get('snippet', '') for item in search_results.get('items', [])]
         sources = [{'title': item.get('title'), 'link': item.get('link')} for item in search_results.get('items', [])]
+        SEARCH_CACHE.set(cache_key, [snippets, sources])
         return snippets, sources
     except requests.exceptions.RequestException as e:
-        print(f"❌ Google搜索请求失败: 查询='{query}', 错误={e}")
+        log_event('search_failed', f"❌ Google搜索请求失败: 查询='{query}', 错误={e}", level='error', query=query, error=str(e))
         return [], []
     except Exception as e:
-        print(f"❌ Google搜索时发生未知错误: 查询='{query}', 错误={e}")
+        log_event('search_failed', f"❌ Google搜索时发生未知错误: 查询='{query}', 错误={e}", level='error', query=query, error=str(e))
         return [], []
 
-# --- 7. 网页爬虫与向量化 ---
-def scrape_website_for_text(url):
+# --- 6.1 网页抓取器 (共享连接池 + 流式下载) ---
+# 所有爬取请求共用一个带 keep-alive 的连接池，避免每个网页都重新握手 TCP/TLS；
+# 正文以流式读取，超过字节上限即停止下载，非 HTML 内容在读取正文前直接拒绝。
+FETCH_TIMEOUT = float(os.getenv("FETCH_TIMEOUT", "10"))
+FETCH_MAX_BYTES = int(os.getenv("FETCH_MAX_BYTES", str(1024 * 1024)))
+FETCH_POOL_SIZE = int(os.getenv("FETCH_POOL_SIZE", "32"))
+FETCH_PER_DOMAIN_CONCURRENCY = max(1, int(os.getenv("FETCH_PER_DOMAIN_CONCURRENCY", "2")))
+FETCH_ALLOWED_CONTENT_TYPES = ('text/html', 'application/xhtml+xml', 'text/plain')
+FETCH_HEADERS = { 'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36' }
+
+HTTP_SESSION = requests.Session()
+HTTP_SESSION.headers.update(FETCH_HEADERS)
+_http_adapter = HTTPAdapter(pool_connections=FETCH_POOL_SIZE, pool_maxsize=FETCH_POOL_SIZE)
+HTTP_SESSION.mount('http://', _http_adapter)
+HTTP_SESSION.mount('https://', _http_adapter)
+
+# 搜索结果不断带来新域名，只为最近用过的 FETCH_DOMAIN_SLOTS_MAX 个域名保留并发名额；
+# 淘汰时跳过仍有请求在使用或等待的域名，避免同一域名同时存在两个信号量
+FETCH_DOMAIN_SLOTS_MAX = 1024
+_domain_semaphores = OrderedDict()  # host -> [BoundedSemaphore, 正在使用或等待的请求数]，按最近使用排序
+_domain_semaphores_lock = threading.Lock()
+
+def _acquire_domain_slot(host, timeout):
+    with _domain_semaphores_lock:
+        entry = _domain_semaphores.get(host)
+        if entry is None:
+            entry = _domain_semaphores[host] = [threading.BoundedSemaphore(FETCH_PER_DOMAIN_CONCURRENCY), 0]
+            if len(_domain_semaphores) > FETCH_DOMAIN_SLOTS_MAX:
+                idle = next((idle_host for idle_host, (_, users) in _domain_semaphores.items() if users == 0), None)
+                if idle is not None: del _domain_semaphores[idle]
+        _domain_semaphores.move_to_end(host)
+        entry[1] += 1
+    if not entry[0].acquire(timeout=timeout):
+        _release_domain_slot(entry, acquired=False)
+        raise requests.exceptions.Timeout(f"等待 {host} 的并发名额超时。")
+    return entry
+
+def _release_domain_slot(entry, acquired=True):
+    if acquired: entry[0].release()
+    with _domain_semaphores_lock:
+        entry[1] -= 1
+
+def fetch_page(url, timeout=FETCH_TIMEOUT, max_bytes=FETCH_MAX_BYTES, etag=None, last_modified=None):
+    """下载网页并返回 {'content', 'encoding', 'content_type', 'truncated', 'etag', 'last_modified'}；
+    非 HTML 内容返回 None。传入 etag / last_modified 时发送条件 GET，服务器返回 304 则得到 {'not_modified': True}。
+
+    timeout 是整次下载的总时长上限 (包括排队等待同域名并发名额的时间)。
+    请求失败时抛出 requests 异常，由调用方处理；域名处于熔断状态时抛出 CircuitOpenError。
+    耗时记在 scrape 阶段，结果按 ok / truncated / not_modified / rejected / circuit_open / error 区分。
+    """
+    with timed_span('scrape') as span:
+        try:
+            page = _fetch_page(url, timeout, max_bytes, etag, last_modified)
+        except CircuitOpenError:
+            span.outcome = 'circuit_open'
+            raise
+        if page is None: span.outcome = 'rejected'
+        elif page.get('not_modified'): span.outcome = 'not_modified'
+        elif page.get('truncated'): span.outcome = 'truncated'
+        return page
+
+def _fetch_page(url, timeout, max_bytes, etag, last_modified):
+    host = (urlparse(url).hostname or '').lower()
+    if not DOMAIN_BREAKER.allow(host): raise CircuitOpenError(f"域名 {host} 处于熔断状态，跳过。")
+    deadline = time.monotonic() + timeout
+    domain_slot = _acquire_domain_slot(host, timeout)
+
+    headers = {}
+    if etag: headers['If-None-Match'] = etag
+    if last_modified: headers['If-Modified-Since'] = last_modified
+    try:
+        with HTTP_SESSION.get(url, timeout=max(0.1, deadline - time.monotonic()), stream=True, headers=headers) as response:
+            DOMAIN_BREAKER.record_success(host)
+            if response.status_code == 304:
+                FETCH_PAGES.inc(outcome='not_modified')
+                return {'not_modified': True}
+            response.raise_for_status()
+            validators = { 'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified') }
+            content_type = response.headers.get('Content-Type', '')
+            mime_type = content_type.split(';')[0].strip().lower()
+            if mime_type and mime_type not in FETCH_ALLOWED_CONTENT_TYPES:
+                log_event('fetch_rejected', f"⏭️ 跳过非HTML内容: {url} (Content-Type: {mime_type})", url=url, content_type=mime_type)
+                FETCH_PAGES.inc(outcome='rejected')
+                return None
+
+            chunks, received, truncated = [], 0, False
+            for chunk in response.iter_content(chunk_size=16384):
+                chunks.append(chunk)
+                received += len(chunk)
+                if received >= max_bytes:
+                    truncated = True
+                    break
+                if time.monotonic() > deadline: raise requests.exceptions.ReadTimeout(f"下载 {url} 超过 {timeout:.1f} 秒。")
+            FETCH_BYTES.inc(received)
+            FETCH_PAGES.inc(outcome='truncated' if truncated else 'ok')
+    except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
+        DOMAIN_BREAKER.record_failure(host)
+        FETCH_PAGES.inc(outcome='error')
+        raise
+    finally:
+        _release_domain_slot(domain_slot)
+
+    charset = re.search(r'charset=["\']?([\w.:-]+)', content_type, re.IGNORECASE)
+    return {
+        'content': b''.join(chunks)[:max_bytes],
+        'encoding': charset.group(1) if charset else None,
+        'content_type': mime_type,
+        'truncated': truncated,
+        **validators
+    }
+
+# --- 6.2 网页正文提取引擎 ---
+# 可插拔的 HTML -> 纯文本提取：默认使用 lxml (C 实现，比 html.parser 快一个数量级)，
+# 未安装 lxml 时自动退回 BeautifulSoup。输出格式与原先的 cleaned_text 完全一致
+# (逐行 strip、按双空格拆分、去掉空行)，并额外支持：
+#   - 去除导航栏、页脚、Cookie 横幅等样板内容 (EXTRACT_REMOVE_BOILERPLATE)
+#   - 收集到 EXTRACT_MAX_CHARS 个字符的正文后立即停止遍历
+try:
+    from lxml import html as lxml_html
+except ImportError:
+    lxml_html = None
+
+TEXT_EXTRACTOR = os.getenv("TEXT_EXTRACTOR", "auto")  # auto | lxml | bs4
+EXTRACT_REMOVE_BOILERPLATE = os.getenv("EXTRACT_REMOVE_BOILERPLATE", "true").lower() == "true"
+EXTRACT_MAX_CHARS = int(os.getenv("EXTRACT_MAX_CHARS", "20000"))
+
+_NON_TEXT_TAGS = {'script', 'style'}
+_BOILERPLATE_TAGS = {'nav', 'footer', 'aside', 'noscript', 'svg', 'template'}
+_BOILERPLATE_ROLES = {'navigation', 'contentinfo', 'alertdialog', 'dialog'}
+_BOILERPLATE_ATTR_PATTERN = re.compile(r'cookie|consent|gdpr|newsletter|breadcrumb|social-share|share-bar|skip-link|site-footer|site-nav', re.IGNORECASE)
+_NEVER_BOILERPLATE_TAGS = {'html', 'body', 'main', 'article'}
+_PRESERVE_WHITESPACE_TAGS = {'pre', 'textarea'}
+_ASCII_SPACES = ' \n\t\x0c\r'
+_LINE_BREAKS = ('\r', '\n', '\x0b', '\x0c', '\x1c', '\x1d', '\x1e', '\x85', '\u2028', '\u2029')
+_LINE_BREAK_PATTERN = re.compile('[' + ''.join(_LINE_BREAKS) + ']')
+_META_CHARSET_PATTERN = re.compile(rb'<meta[^>]+charset=["\']?([\w.:-]+)', re.IGNORECASE)
+_XML_DECLARATION_PATTERN = re.compile(r'^\s*<\?xml[^>]*\?>')
+
+def _is_boilerplate(tag, attrs):
+    if tag in _NEVER_BOILERPLATE_TAGS: return False
+    if tag in _BOILERPLATE_TAGS: return True
+    if attrs.get('role') in _BOILERPLATE_ROLES: return True
+    marker = f"{attrs.get('id') or ''} {attrs.get('class') or ''}"
+    if isinstance(attrs.get('class'), list): marker = f"{attrs.get('id') or ''} {' '.join(attrs['class'])}"
+    return bool(marker.strip()) and bool(_BOILERPLATE_ATTR_PATTERN.search(marker))
+
+def _normalize_text_stream(pieces, max_chars=None):
+    """把原始文本片段流规整为 cleaned_text 格式；收集到 max_chars 个字符后停止消费片段流。"""
+    output, pending, pending_len, total = [], [], 0, 0
+    def emit(text):
+        nonlocal total
+        for line in text.splitlines():
+            for phrase in line.strip().split("  "):
+                phrase = phrase.strip()
+                if phrase:
+                    output.append(phrase)
+                    total += len(phrase) + 1
+    for piece in pieces:
+        pending.append(piece)
+        pending_len += len(piece)
+        if _LINE_BREAK_PATTERN.search(piece):
+            lines = ''.join(pending).splitlines(keepends=True)
+            # 最后一行如果没有换行符结尾，可能还会和下一个片段连在一起，先留在缓冲区
+            tail = lines.pop() if not lines[-1].endswith(_LINE_BREAKS) else ''
+            emit(''.join(lines))
+            pending, pending_len = ([tail], len(tail)) if tail else ([], 0)
+        elif max_chars and pending_len >= 2 * max_chars:
+            break  # 压缩过的 HTML 常常整页只有一行，不必等到行尾
+        if max_chars and total >= max_chars: break
+    emit(''.join(pending))
+    return '\n'.join(output)
+
+def _collapse_whitespace(text, preserve):
+    # BeautifulSoup 会把纯 ASCII 空白的字符串折叠为单个空格 (或换行)，这里保持一致
+    if preserve or text.strip(_ASCII_SPACES): return text
+    return '\n' if '\n' in text else ' '
+
+def _iter_text_lxml(root, remove_boilerplate):
+    # 用显式栈代替递归，按文档顺序产出文本：节点文本 -> 子节点 -> 节点尾随文本
+    stack = [(root, False)]
+    while stack:
+        node, in_pre = stack.pop()
+        if isinstance(node, str):
+            yield node
+            continue
+        if node is not root and node.tail: stack.append((_collapse_whitespace(node.tail, in_pre), in_pre))
+        tag = node.tag
+        if not isinstance(tag, str) or tag in _NON_TEXT_TAGS: continue  # 注释、处理指令、脚本
+        if remove_boilerplate and _is_boilerplate(tag, node.attrib): continue
+        child_in_pre = in_pre or tag in _PRESERVE_WHITESPACE_TAGS
+        stack.extend((child, child_in_pre) for child in reversed(node))
+        if node.text: yield _collapse_whitespace(node.text, child_in_pre)
+
+def _decode_html(content, encoding):
+    if isinstance(content, str): return content
+    if not encoding:
+        meta = _META_CHARSET_PATTERN.search(content[:2048])
+        encoding = meta.group(1).decode('ascii', 'ignore') if meta else 'utf-8'
     try:
-        headers = { 'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36' }
-        response = requests.get(url, headers=headers, timeout=10); response.raise_for_status()
-        soup = BeautifulSoup(response.content, 'html.parser')
-        [s.decompose() for s in soup(['script', 'style'])]
-        cleaned_text = '\n'.join(chunk for chunk in (phrase.strip() for line in (line.strip() for line in soup.get_text().splitlines()) for phrase in line.split("  ")) if chunk)
-        
-        if cleaned_text and PINECONE_INDEX:
+        return content.decode(encoding, errors='replace')
+    except LookupError:
+        return content.decode('utf-8', errors='replace')
+
+def _extract_text_lxml(content, encoding, remove_boilerplate, max_chars):
+    text = _XML_DECLARATION_PATTERN.sub('', _decode_html(content, encoding), count=1)
+    if not text.strip(): return ''
+    root = lxml_html.document_fromstring(text)
+    return _normalize_text_stream(_iter_text_lxml(root, remove_boilerplate), max_chars)
+
+def _extract_text_bs4(content, encoding, remove_boilerplate, max_chars):
+    from bs4 import BeautifulSoup  # 只在未安装 lxml 或 lxml 失败时使用，不在启动时导入
+    soup = BeautifulSoup(content, 'html.parser', from_encoding=encoding if isinstance(content, bytes) else None)
+    [s.decompose() for s in soup(['script', 'style'])]
+    if remove_boilerplate:
+        [s.decompose() for s in soup.find_all(lambda tag: _is_boilerplate(tag.name, tag.attrs))]
+    cleaned_text = _normalize_text_stream([soup.get_text()])
+    return cleaned_text[:max_chars] if max_chars else cleaned_text
+
+TEXT_EXTRACTORS = {'lxml': _extract_text_lxml, 'bs4': _extract_text_bs4}
+
+def extract_text(content, encoding=None, backend=None, remove_boilerplate=None, max_chars=None):
+    """把 HTML (bytes 或 str) 转换为 cleaned_text 格式的纯文本。"""
+    backend = backend or TEXT_EXTRACTOR
+    if backend == 'auto': backend = 'lxml' if lxml_html is not None else 'bs4'
+    if remove_boilerplate is None: remove_boilerplate = EXTRACT_REMOVE_BOILERPLATE
+    if max_chars is None: max_chars = EXTRACT_MAX_CHARS
+    try:
+        return TEXT_EXTRACTORS[backend](content, encoding, remove_boilerplate, max_chars)
+    except Exception as e:
+        if backend == 'bs4': raise
+        log_event('extract_fallback', f"⚠️ {backend} 提取失败，退回 BeautifulSoup: {e}", level='warning', backend=backend, error=str(e))
+        return _extract_text_bs4(content, encoding, remove_boilerplate, max_chars)
+
+# --- 6.3 后台批量向量索引器 ---
+# 爬取到的网页不再在用户请求中同步生成向量并写入 Pinecone，而是放入一个有界队列，
+# 由后台线程攒批后一次性调用 embed_content (多段内容) 和 upsert (多条向量)。
+# 失败时按指数退避重试；进程退出时 (atexit / gunicorn worker_exit) 会尽量把队列刷完。
+EMBEDDING_MODEL = 'models/text-embedding-004'
+INDEX_QUEUE_MAX = int(os.getenv("INDEX_QUEUE_MAX", "500"))
+INDEX_BATCH_SIZE = max(1, min(100, int(os.getenv("INDEX_BATCH_SIZE", "32"))))  # batchEmbedContents 单次最多 100 条
+INDEX_FLUSH_INTERVAL = float(os.getenv("INDEX_FLUSH_INTERVAL", "2"))
+INDEX_MAX_RETRIES = int(os.getenv("INDEX_MAX_RETRIES", "4"))
+INDEX_RETRY_BASE_DELAY = float(os.getenv("INDEX_RETRY_BASE_DELAY", "1"))
+INDEX_SHUTDOWN_TIMEOUT = float(os.getenv("INDEX_SHUTDOWN_TIMEOUT", "8"))
+INDEX_CHUNK_SIZE = int(os.getenv("INDEX_CHUNK_SIZE", "1000"))
+INDEX_CHUNK_OVERLAP = int(os.getenv("INDEX_CHUNK_OVERLAP", "200"))
+
+_index_queue = queue.Queue(maxsize=INDEX_QUEUE_MAX)
+_indexer_thread = None
+_indexer_lock = threading.Lock()
+_INDEXER_STOP = object()
+
+def normalize_company_name(name):
+    """公司名规范化 (小写、合并空白、去掉首尾标点)，用作 Pinecone 元数据过滤键。"""
+    return re.sub(r'\s+', ' ', (name or '').casefold()).strip(' .,;:"\'')
+
+def chunk_text(text, chunk_size=None, overlap=None):
+    """把 cleaned_text 按行切成相互重叠的段落，每段约 chunk_size 个字符。"""
+    chunk_size = chunk_size or INDEX_CHUNK_SIZE
+    overlap = INDEX_CHUNK_OVERLAP if overlap is None else overlap
+    step = max(1, chunk_size - overlap)
+    lines = []
+    for line in text.splitlines():
+        if len(line) <= chunk_size:
+            lines.append(line)
+        else:
+            # 超长的单行按固定步长硬切，保证每段都不超过 chunk_size
+            lines.extend(line[i:i + chunk_size] for i in range(0, len(line) - overlap, step))
+
+    chunks, current, current_len = [], [], 0
+    for line in lines:
+        if current and current_len + len(line) + 1 > chunk_size:
+            chunks.append('\n'.join(current))
+            # 从当前段末尾保留不超过 overlap 个字符的整行，作为下一段的开头
+            carried, carried_len = [], 0
+            for previous in reversed(current):
+                if carried_len + len(previous) + 1 > overlap: break
+                carried.insert(0, previous)
+                carried_len += len(previous) + 1
+            current, current_len = carried, carried_len
+        current.append(line)
+        current_len += len(line) + 1
+    if current: chunks.append('\n'.join(current))
+    return chunks
+
+def chunk_id(url, index):
+    # Pinecone 的 ID 最长 512 字节，用 URL 的哈希保证长度固定且同一网页重复索引时覆盖旧数据
+    return f"{hashlib.sha1(url.encode('utf-8')).hexdigest()}#{index}"
+
+def enqueue_for_indexing(url, text, company=None, lang=None):
+    """把网页文本放入后台索引队列，不阻塞调用方；队列已满或没有可用的向量索引时返回 False。"""
+    if not (PINECONE_INDEX or LOCAL_VECTOR_INDEX) or not text: return False
+    _ensure_indexer_started()
+    document = { 'url': url, 'text': text, 'company': normalize_company_name(company), 'lang': lang or '', 'scraped_at': datetime.datetime.now().isoformat() }
+    try:
+        _index_queue.put_nowait(document)
+        return True
+    except queue.Full:
+        log_event('index_queue_full', f"⚠️ 索引队列已满 ({INDEX_QUEUE_MAX})，跳过 {url} 的向量化。", level='warning', url=url, queue_max=INDEX_QUEUE_MAX)
+        return False
+
+def _ensure_indexer_started():
+    global _indexer_thread
+    if _indexer_thread and _indexer_thread.is_alive(): return
+    with _indexer_lock:
+        if _indexer_thread and _indexer_thread.is_alive(): return
+        _indexer_thread = threading.Thread(target=_indexer_loop, name='pinecone-indexer', daemon=True)
+        _indexer_thread.start()
+
+def _with_retries(action, description):
+    for attempt in range(INDEX_MAX_RETRIES + 1):
+        try:
+            return action()
+        except Exception as e:
+            if attempt == INDEX_MAX_RETRIES: raise
+            delay = INDEX_RETRY_BASE_DELAY * (2 ** attempt) * random.uniform(0.5, 1.0)
+            log_event('index_retry', f"⚠️ {description} 失败 (第 {attempt + 1} 次): {e}，{delay:.1f} 秒后重试...", level='warning', action=description, attempt=attempt + 1, delay_seconds=round(delay, 2), error=str(e))
+            time.sleep(delay)
+
+def _index_batch(documents):
+    chunks = [(doc, i, passage) for doc in documents for i, passage in enumerate(chunk_text(doc['text']))]
+    log_event('index_batch_start', f"📦 开始为 {len(documents)} 个网页 ({len(chunks)} 个段落) 批量生成向量并存入向量索引...", documents=len(documents), passages=len(chunks))
+    for start in range(0, len(chunks), INDEX_BATCH_SIZE):
+        batch = chunks[start:start + INDEX_BATCH_SIZE]
+        with timed_span('embed_documents', passages=len(batch)):
+            result = _with_retries(lambda: genai.embed_content(model=EMBEDDING_MODEL, content=[passage for _, _, passage in batch], task_type='RETRIEVAL_DOCUMENT'), "批量生成向量")
+        vectors = [{
+            'id': chunk_id(doc['url'], i),
+            'values': embedding,
+            'metadata': {
+                'source_type': 'web_scrape',
+                'source_url': doc['url'],
+                'snippet': passage,
+                'chunk_index': i,
+                'company': doc['company'],
+                'lang': doc['lang'],
+                'scraped_at': doc['scraped_at']
+            }
+        } for (doc, i, passage), embedding in zip(batch, result['embedding'])]
+        # 先写本地索引：同一家公司的后续请求无需等待 Pinecone 写入生效即可命中
+        if LOCAL_VECTOR_INDEX:
+            with timed_span('upsert_local'): LOCAL_VECTOR_INDEX.upsert(vectors)
+        if PINECONE_INDEX:
+            with timed_span('upsert_pinecone'): _with_retries(lambda: PINECONE_INDEX.upsert(vectors=vectors), "批量写入Pinecone")
+    if LOCAL_VECTOR_INDEX: LOCAL_VECTOR_INDEX.save()
+    log_event('index_batch_done', f"✅ 成功将 {len(chunks)} 个段落向量存入{'Pinecone' if PINECONE_INDEX else '本地向量索引'}。", passages=len(chunks), target='pinecone' if PINECONE_INDEX else 'local')
+
+def _indexer_loop():
+    stopping = False
+    while not stopping:
+        item = _index_queue.get()
+        if item is _INDEXER_STOP: break
+        batch, deadline = [item], time.monotonic() + INDEX_FLUSH_INTERVAL
+        while len(batch) < INDEX_BATCH_SIZE:
             try:
-                print(f"📦 开始为 {url} 生成向量并存入Pinecone...")
-                vector = genai.embed_content(model='models/text-embedding-004', content=cleaned_text, task_type='RETRIEVAL_DOCUMENT')
-                metadata = {
-                    'source_type': 'web_scrape',
-                    'source_url': url,
-                    'snippet': cleaned_text[:500],
-                    'scraped_at': datetime.datetime.now().isoformat()
-                }
-                PINECONE_INDEX.upsert(vectors=[{'id': url, 'values': vector['embedding'], 'metadata': metadata}])
-                print(f"✅ 成功将 {url} 的向量存入Pinecone。")
-            except Exception as e:
-                print(f"❌ 存入Pinecone时发生错误 (URL: {url}): {e}")
+                item = _index_queue.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if item is _INDEXER_STOP:
+                stopping = True
+                break
+            batch.append(item)
+        try:
+            _index_batch(batch)
+        except Exception as e:
+            log_event('index_batch_failed', f"❌ 批量存入向量索引时发生错误 ({len(batch)} 个网页): {e}", level='error', documents=len(batch), error=str(e))
+
+def shutdown_indexer(timeout=INDEX_SHUTDOWN_TIMEOUT):
+    """刷完索引队列后停止后台线程，并保存本地向量索引。供 atexit 与 gunicorn 的 worker_exit 钩子调用。"""
+    if not (_indexer_thread and _indexer_thread.is_alive()):
+        if LOCAL_VECTOR_INDEX: LOCAL_VECTOR_INDEX.save(force=True)
+        return
+    pending = _index_queue.qsize()
+    log_event('indexer_flush', f"⏳ 正在刷新索引队列 (剩余 {pending} 个网页)...", pending=pending)
+    try:
+        _index_queue.put(_INDEXER_STOP, timeout=timeout)
+    except queue.Full:
+        log_event('indexer_stop_failed', "⚠️ 索引队列已满，无法发送停止信号。", level='warning')
+        return
+    _indexer_thread.join(timeout)
+    if _indexer_thread.is_alive(): log_event('indexer_flush_timeout', f"⚠️ 索引队列未能在 {timeout} 秒内刷完，剩余约 {_index_queue.qsize()} 个网页被丢弃。", level='warning', timeout=timeout, dropped=_index_queue.qsize())
+    if LOCAL_VECTOR_INDEX: LOCAL_VECTOR_INDEX.save(force=True)
+
+atexit.register(shutdown_indexer)
+
+# --- 6.4 本地向量索引 ---
+# 进程内的 NumPy 向量索引，镜像后台索引器最近写入的向量，在本地计算余弦相似度回答 top-k 查询，
+# 接口与 Pinecone Index 的 upsert / query 兼容 (支持 $eq / $in / $ne / $nin 元数据过滤)。
+# 配置了 Pinecone 时作为前置缓存，命中足够多的相关段落就不再访问 Pinecone；
+# 未配置 Pinecone 时作为唯一的向量索引，测试与基准测试也可以直接用它替换 PINECONE_INDEX。
+# 设置 LOCAL_INDEX_PATH 后向量保存在内存映射文件中，实例重启后无需重新向量化即可恢复。
+# 多个 Worker 进程各自占用一个编号槽位 (LOCAL_INDEX_PATH.0、.1 ...)，不会写同一组文件。
+try:
+    import numpy as np
+except ImportError:  # 未安装 numpy 时不启用本地索引
+    np = None
+try:
+    import fcntl
+except ImportError:  # 非 POSIX 平台无法用文件锁区分 Worker
+    fcntl = None
+
+LOCAL_INDEX_CAPACITY = int(os.getenv("LOCAL_INDEX_CAPACITY", "20000"))  # 0 表示禁用
+LOCAL_INDEX_PATH = os.getenv("LOCAL_INDEX_PATH", "")
+LOCAL_INDEX_SAVE_INTERVAL = float(os.getenv("LOCAL_INDEX_SAVE_INTERVAL", "30"))
+LOCAL_INDEX_MIN_MATCHES = int(os.getenv("LOCAL_INDEX_MIN_MATCHES", "3"))  # 本地相关段落达到此数量即视为前置缓存命中
+RAG_MIN_SCORE = 0.5
+
+QUERY_EMBEDDING_CACHE = StageCache('query_embedding', int(os.getenv("QUERY_EMBEDDING_CACHE_MAX_BYTES", str(16 * 1024 * 1024))), int(os.getenv("QUERY_EMBEDDING_CACHE_TTL", "604800")))
+STAGE_CACHES.append(QUERY_EMBEDDING_CACHE)
+
+def _metadata_matches(metadata, metadata_filter):
+    for field, condition in (metadata_filter or {}).items():
+        value = metadata.get(field)
+        if not isinstance(condition, dict): condition = {'$eq': condition}
+        for operator, operand in condition.items():
+            if operator == '$eq' and value != operand: return False
+            if operator == '$ne' and value == operand: return False
+            if operator == '$in' and value not in operand: return False
+            if operator == '$nin' and value in operand: return False
+            if operator not in ('$eq', '$ne', '$in', '$nin'): raise ValueError(f"Unsupported filter operator: {operator}")
+    return True
+
+_index_slot_lock_file = None
+
+def claim_local_index_path(base_path, max_slots=64):
+    """用文件锁为当前进程占用一个索引文件槽位，返回该槽位的路径前缀；无法保证独占时返回 None (不持久化)。
+    锁随进程退出自动释放，重启后的 Worker 会重新占用空出的槽位并加载上一个进程留下的数据。"""
+    global _index_slot_lock_file
+    if fcntl is None:
+        if int(os.getenv("WEB_CONCURRENCY", "1")) > 1:
+            log_event('local_index_unpersisted', f"⚠️ 当前平台不支持文件锁，多个 Worker 无法安全共享 {base_path}，本地向量索引不做持久化。", level='warning', path=base_path)
+            return None
+        return base_path
+    for slot in range(max_slots):
+        lock_file = open(f"{base_path}.{slot}.lock", 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            continue
+        _index_slot_lock_file = lock_file  # 保持打开以持有锁
+        return f"{base_path}.{slot}"
+    log_event('local_index_unpersisted', f"⚠️ {base_path} 的 {max_slots} 个槽位都已被占用，本地向量索引不做持久化。", level='warning', path=base_path)
+    return None
+
+class LocalVectorIndex:
+    """容量有界的内存向量索引，写满后淘汰最早写入的向量。向量在写入时归一化，查询即矩阵乘法。"""
+
+    def __init__(self, capacity, path=None):
+        self.capacity = capacity
+        self.path = path
+        self._matrix = None          # (capacity, dim) float32，设置 path 时为内存映射文件
+        self._rows = OrderedDict()   # id -> 行号，按写入顺序排列
+        self._ids = {}               # 行号 -> id
+        self._metadata = {}          # 行号 -> metadata
+        self._company_rows = {}      # metadata['company'] -> 行号集合，按公司过滤时不必扫描全部向量
+        self._free_rows = []
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._last_saved = time.monotonic()
+        if path and os.path.exists(path + '.json'): self._load()
+
+    def _allocate(self, dim):
+        if self.path:
+            self._matrix = np.lib.format.open_memmap(self.path + '.npy', mode='w+', dtype=np.float32, shape=(self.capacity, dim))
+        else:
+            self._matrix = np.zeros((self.capacity, dim), dtype=np.float32)
+        self._free_rows = list(range(self.capacity - 1, -1, -1))
+
+    def _load(self):
+        try:
+            with open(self.path + '.json', encoding='utf-8') as f:
+                saved = json.load(f)
+            matrix = np.load(self.path + '.npy', mmap_mode='r+')
+            if matrix.shape[0] != self.capacity: raise ValueError(f"capacity changed ({matrix.shape[0]} -> {self.capacity})")
+        except Exception as e:
+            log_event('local_index_load_failed', f"⚠️ 无法加载本地向量索引 {self.path}: {e}，将重新建立。", level='warning', path=self.path, error=str(e))
+            return
+        self._matrix = matrix
+        for vector_id, row, metadata in saved['entries']:
+            self._rows[vector_id] = row
+            self._set_row(row, vector_id, metadata)
+        used = set(self._rows.values())
+        self._free_rows = [row for row in range(self.capacity - 1, -1, -1) if row not in used]
+        log_event('local_index_loaded', f"✅ 从 {self.path} 加载了 {len(self._rows)} 条本地向量。", path=self.path, vectors=len(self._rows))
+
+    def _set_row(self, row, vector_id, metadata):
+        self._ids[row] = vector_id
+        self._metadata[row] = metadata
+        self._company_rows.setdefault(metadata.get('company'), set()).add(row)
+
+    def _clear_row(self, row):
+        self._ids.pop(row, None)
+        metadata = self._metadata.pop(row, None)
+        if metadata is None: return
+        rows = self._company_rows.get(metadata.get('company'))
+        if rows is not None:
+            rows.discard(row)
+            if not rows: del self._company_rows[metadata.get('company')]
+
+    def _candidate_rows(self, metadata_filter):
+        """按公司的等值过滤先用 _company_rows 缩小范围，其余条件只在这些行上逐条检查。"""
+        company = (metadata_filter or {}).get('company')
+        if isinstance(company, dict) and set(company) == {'$eq'}: company = company['$eq']
+        if company is None or isinstance(company, dict):
+            rows = self._rows.values()
+        else:
+            rows = self._company_rows.get(company, ())
+        return [row for row in rows if _metadata_matches(self._metadata[row], metadata_filter)]
+
+    def upsert(self, vectors, **kwargs):
+        with self._lock:
+            for vector in vectors:
+                values = np.asarray(vector['values'], dtype=np.float32)
+                if self._matrix is None: self._allocate(values.shape[0])
+                if values.shape[0] != self._matrix.shape[1]: raise ValueError(f"Vector dimension {values.shape[0]} does not match index dimension {self._matrix.shape[1]}")
+                row = self._rows.pop(vector['id'], None)
+                if row is None:
+                    if not self._free_rows:
+                        _, evicted_row = self._rows.popitem(last=False)
+                        self._clear_row(evicted_row)
+                        self._free_rows.append(evicted_row)
+                    row = self._free_rows.pop()
+                else:
+                    self._clear_row(row)
+                norm = float(np.linalg.norm(values))
+                self._matrix[row] = values / norm if norm else values
+                self._rows[vector['id']] = row
+                self._set_row(row, vector['id'], vector.get('metadata') or {})
+            self._dirty = True
+        return {'upserted_count': len(vectors)}
+
+    def query(self, vector, top_k=10, include_metadata=True, filter=None, **kwargs):
+        with self._lock:
+            if self._matrix is None or not self._rows: return {'matches': []}
+            candidates = self._candidate_rows(filter)
+            if not candidates: return {'matches': []}
+            rows = np.fromiter(candidates, dtype=np.int64, count=len(candidates))
+            query_vector = np.asarray(vector, dtype=np.float32)
+            norm = float(np.linalg.norm(query_vector))
+            scores = self._matrix[rows] @ (query_vector / norm if norm else query_vector)
+            top = np.argpartition(-scores, top_k - 1)[:top_k] if len(scores) > top_k else np.arange(len(scores))
+            top = top[np.argsort(-scores[top], kind='stable')]
+            return {'matches': [{
+                'id': self._ids[candidates[i]],
+                'score': float(scores[i]),
+                'metadata': dict(self._metadata[candidates[i]]) if include_metadata else None,
+            } for i in top]}
 
+    def save(self, force=False):
+        """把元数据写入 JSON (向量已在内存映射文件中)；默认最多每 LOCAL_INDEX_SAVE_INTERVAL 秒写一次。"""
+        if not self.path: return
+        with self._lock:
+            if not self._dirty or (not force and time.monotonic() - self._last_saved < LOCAL_INDEX_SAVE_INTERVAL): return
+            self._matrix.flush()
+            entries = [[vector_id, row, self._metadata[row]] for vector_id, row in self._rows.items()]
+            self._dirty, self._last_saved = False, time.monotonic()
+        tmp_path = self.path + '.json.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'entries': entries}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path + '.json')
+
+    def stats(self):
+        with self._lock:
+            return {'vectors': len(self._rows), 'capacity': self.capacity, 'persistent': bool(self.path)}
+
+LOCAL_VECTOR_INDEX = LocalVectorIndex(LOCAL_INDEX_CAPACITY, claim_local_index_path(LOCAL_INDEX_PATH) if LOCAL_INDEX_PATH else None) if np is not None and LOCAL_INDEX_CAPACITY > 0 else None
+
+def _query_embedding_key(text):
+    return hashlib.sha256(f"{EMBEDDING_MODEL}|{_normalize_field(text)}".encode('utf-8')).hexdigest()
+
+def embed_query(text, timeout=None):
+    """生成查询向量，按 (模型, 规范化查询) 缓存，重复查询不再访问 embed_content。"""
+    key = _query_embedding_key(text)
+    cached = QUERY_EMBEDDING_CACHE.get(key)
+    if cached is not None: return cached
+    with timed_span('embed_query'):
+        embedding = genai.embed_content(model=EMBEDDING_MODEL, content=text, task_type='RETRIEVAL_QUERY', request_options={'timeout': timeout} if timeout else None)['embedding']
+    QUERY_EMBEDDING_CACHE.set(key, embedding)
+    return embedding
+
+def embed_queries(texts):
+    """批量生成查询向量并写入缓存 (每次最多 100 条)，之后的 embed_query 直接命中缓存。"""
+    keys = {_query_embedding_key(text): text for text in texts}
+    missing = [(key, text) for key, text in keys.items() if key not in QUERY_EMBEDDING_CACHE]
+    for start in range(0, len(missing), 100):
+        batch = missing[start:start + 100]
+        with timed_span('embed_query_batch', queries=len(batch)):
+            result = genai.embed_content(model=EMBEDDING_MODEL, content=[text for _, text in batch], task_type='RETRIEVAL_QUERY')
+        for (key, _), embedding in zip(batch, result['embedding']): QUERY_EMBEDDING_CACHE.set(key, embedding)
+    return len(missing)
+
+def query_vector_indexes(vector, top_k, metadata_filter, timeout):
+    """先查本地索引，相关段落不足时再查 Pinecone。返回 (相关匹配, 来源 'local' / 'pinecone')。"""
+    if LOCAL_VECTOR_INDEX:
+        with timed_span('vector_query_local'):
+            local_matches = [match for match in LOCAL_VECTOR_INDEX.query(vector=vector, top_k=top_k, filter=metadata_filter)['matches'] if match['score'] > RAG_MIN_SCORE]
+        if not PINECONE_INDEX or len(local_matches) >= min(top_k, LOCAL_INDEX_MIN_MATCHES): return local_matches, 'local'
+    if not PINECONE_INDEX: return [], None
+    with timed_span('vector_query_pinecone'):
+        query_results = PINECONE_GUARD.call(PINECONE_INDEX.query, timeout, vector=vector, top_k=top_k, include_metadata=True, filter=metadata_filter)
+    return [match for match in query_results['matches'] if match['score'] > RAG_MIN_SCORE], 'pinecone'
+
+# --- 6.5 自适应搜索规划器 ---
+# 原先每次分析固定发出约 15 个 num=2 的搜索，其中大量结果落在相同的 Glassdoor / Indeed 页面上。
+# 规划器把相近的分析维度用 OR 合并成少量查询，按历史产出 (每次调用带来的新链接数的指数滑动平均)
+# 从高到低分批 (wave) 发出；CSE 按调用次数计费而与 num 无关，因此每批按还缺的来源数提高 num。
+# 已找到足够多的不同链接和域名后不再发出新查询。未命中缓存的调用受单次请求预算和每日配额限制。
+CSE_DAILY_QUOTA = int(os.getenv("CSE_DAILY_QUOTA", "0"))  # 0 表示不限制 (只由 Google 一侧的配额约束)，设置为账号的实际每日配额后在本地提前停止
+CSE_QUOTA_REDIS_RETRY_SECONDS = 30  # 共享计数失败后改用进程内计数的时长，期间不再等待 Redis 超时
+CSE_REQUEST_BUDGET = int(os.getenv("CSE_REQUEST_BUDGET", "5"))
+RESEARCH_TARGET_DOMAINS = int(os.getenv("RESEARCH_TARGET_DOMAINS", "6"))
+RESEARCH_WAVE_SIZE = max(1, int(os.getenv("RESEARCH_WAVE_SIZE", "3")))
+SEARCH_MIN_NUM, SEARCH_MAX_NUM = 2, 10  # CSE 单次最多返回 10 条
+SEARCH_YIELD_ALPHA = 0.2
+
+# 'aspects' 是原先逐个查询的分析维度 (上下文打包器也用它们打分)，'terms' 是合并后 OR 查询中的关键词，
+# 'prior' 是还没有统计数据时的预期产出
+RESEARCH_QUERY_GROUPS = OrderedDict([
+    ('review_sites', {'aspects': ["company culture review"], 'terms': ['reviews'], 'sites': ['glassdoor.com', 'indeed.com', 'linkedin.com'], 'prior': 4.0}),
+    ('culture', {'aspects': ["work life balance", "management style", "overtime culture"], 'terms': ['culture', '"work life balance"', '"management style"', 'overtime'], 'prior': 3.0}),
+    ('compensation', {'aspects': ["salary benefits", "growth opportunities", "training programs"], 'terms': ['salary', 'benefits', '"career growth"', 'training'], 'prior': 2.5}),
+    ('hiring', {'aspects': ["hiring process interview", "scam fraud"], 'terms': ['interview', '"hiring process"', 'scam', 'fraud'], 'prior': 2.0}),
+    ('values', {'aspects': ["innovation culture", "diversity inclusion", "sustainability"], 'terms': ['innovation', 'diversity', 'inclusion', 'sustainability'], 'prior': 1.5}),
+])
+
+class CseQuota:
+    """按 UTC 自然日计数的 Custom Search 调用配额。传入 redis_url 时所有进程共享同一个计数，
+    Redis 不可用时退回进程内计数；Redis 出错后熔断 CSE_QUOTA_REDIS_RETRY_SECONDS 秒，之后只放行一次试探。"""
+
+    def __init__(self, daily_limit, redis_url=None):
+        self.daily_limit = daily_limit
+        self.redis_url = redis_url
+        self._redis_host = urlparse(redis_url).netloc if redis_url else None
+        self._redis_breaker = CircuitBreaker(failure_threshold=1, cooldown=CSE_QUOTA_REDIS_RETRY_SECONDS)
+        self._day = None
+        self._used = 0
+        self._lock = threading.Lock()
+
+    def _roll(self):
+        today = datetime.datetime.utcnow().date()
+        if today != self._day: self._day, self._used = today, 0
+
+    def _shared_key(self):
+        return f"project_lens:cse_quota:{datetime.datetime.utcnow().date().isoformat()}"
+
+    def _shared_used(self, increment=False):
+        """读取 (或先加一再读取) 共享计数；失败时返回 None。"""
+        if not self.redis_url or not self._redis_breaker.allow(self._redis_host): return None
+        try:
+            client, key = get_redis(self.redis_url), self._shared_key()
+            if not increment:
+                used = int(client.get(key) or 0)
+            else:
+                used, _ = client.pipeline().incr(key).expire(key, 2 * 86400).execute()
+            self._redis_breaker.record_success(self._redis_host)
+            return used
+        except Exception as e:
+            self._redis_breaker.record_failure(self._redis_host)
+            log_event('cse_quota_shared_failed', f"⚠️ 读取共享搜索配额失败: {e}，改用进程内计数。", level='warning', error=str(e))
+            return None
+
+    def try_acquire(self):
+        used = self._shared_used(increment=True)
+        if used is not None: return not self.daily_limit or used <= self.daily_limit
+        with self._lock:
+            self._roll()
+            if self.daily_limit and self._used >= self.daily_limit: return False
+            self._used += 1
+            return True
+
+    def _used_today(self):
+        used = self._shared_used()
+        if used is not None: return min(used, self.daily_limit) if self.daily_limit else used
+        with self._lock:
+            self._roll()
+            return self._used
+
+    def remaining(self):
+        return max(0, self.daily_limit - self._used_today()) if self.daily_limit else float('inf')
+
+    def stats(self):
+        return {'used_today': self._used_today(), 'daily_limit': self.daily_limit or None, 'shared': bool(self.redis_url)}
+
+CSE_QUOTA = CseQuota(CSE_DAILY_QUOTA, REDIS_URL or None)
+_search_group_yield = {name: group['prior'] for name, group in RESEARCH_QUERY_GROUPS.items()}
+_search_group_yield_lock = threading.Lock()
+
+def build_group_query(company_name, location, group):
+    location_part = f' "{location}"' if location else ""
+    query = f'"{company_name}"{location_part} ' + ' OR '.join(group['terms'])
+    if group.get('sites'): query += ' (' + ' OR '.join(f'site:{site}' for site in group['sites']) + ')'
+    return query
+
+class SearchPlan:
+    """一次分析的搜索计划。run_research_stage 反复调用 next_wave() 取下一批查询，
+    每个查询返回后调用 record()；目标已达成、分组用完或预算耗尽时 next_wave() 返回空列表。"""
+
+    def __init__(self, company_name, location=None, budget=None, target_sources=None, target_domains=None):
+        self.company_name, self.location = company_name, location
+        self.budget = CSE_REQUEST_BUDGET if budget is None else budget
+        self.target_sources = RESEARCH_TARGET_SOURCES if target_sources is None else target_sources
+        self.target_domains = RESEARCH_TARGET_DOMAINS if target_domains is None else target_domains
+        with _search_group_yield_lock:
+            # 预期产出高的分组先发；同分时保持定义顺序
+            self._remaining_groups = sorted(RESEARCH_QUERY_GROUPS, key=lambda name: -_search_group_yield[name])
+        self.queries = []   # [(group, query, num)]，按发出顺序，下标即 record() 的 index
+        self.upstream_calls = 0
+        self.quota_exhausted = False  # 因每日配额用完而停止 (区别于单次请求预算)
+        self.links, self.domains = set(), set()
+
+    def satisfied(self):
+        return len(self.links) >= self.target_sources and len(self.domains) >= self.target_domains
+
+    def next_wave(self):
+        if self.satisfied() or not self._remaining_groups: return []
+        wave_groups = self._remaining_groups[:RESEARCH_WAVE_SIZE]
+        missing = max(1, self.target_sources - len(self.links))
+        num = max(SEARCH_MIN_NUM, min(SEARCH_MAX_NUM, math.ceil(missing * 1.5 / len(wave_groups))))
+        wave = []
+        for name in wave_groups:
+            query = build_group_query(self.company_name, self.location, RESEARCH_QUERY_GROUPS[name])
+            if search_cache_key(query, num) not in SEARCH_CACHE:
+                if self.upstream_calls >= self.budget or CSE_QUOTA.remaining() < 1:
+                    self.quota_exhausted = CSE_QUOTA.remaining() < 1
+                    log_event('search_budget_exhausted', f"⚠️ 搜索预算已用完 (本次 {self.upstream_calls}/{self.budget}, 今日剩余 {CSE_QUOTA.remaining()})，停止发出新查询。", level='warning', upstream_calls=self.upstream_calls, budget=self.budget)
+                    self._remaining_groups = []
+                    break
+                self.upstream_calls += 1
+            self._remaining_groups.remove(name)
+            self.queries.append((name, query, num))
+            wave.append((len(self.queries) - 1, query, num))
+        return wave
+
+    def record(self, index, sources_data):
+        links = [source['link'] for source in sources_data if source.get('link')]
+        new_links = [link for link in links if link not in self.links]
+        self.links.update(links)
+        self.domains.update(urlparse(link).netloc.lower() for link in links)
+        with _search_group_yield_lock:
+            name = self.queries[index][0]
+            _search_group_yield[name] += SEARCH_YIELD_ALPHA * (len(new_links) - _search_group_yield[name])
+
+# --- 7. 网页爬虫与向量化 ---
+def scrape_website_for_text(url, company=None, lang=None, timeout=FETCH_TIMEOUT):
+    # 同一网页被多个并发请求同时需要时只爬取一次 (按首个请求的公司名写入索引)
+    return _scrape_flights.do(url, _scrape_website_for_text, url, company, lang, timeout)
+
+def _scrape_website_for_text(url, company, lang, timeout):
+    cached_page = PAGE_CACHE.get(url)
+    try:
+        if cached_page and time.time() - cached_page['fetched_at'] < PAGE_CACHE_FRESH_SECONDS:
+            record_span_outcome('scrape', 'cache_hit')
+            return cached_page['text']
+
+        page = fetch_page(url, timeout=timeout, etag=cached_page and cached_page['etag'], last_modified=cached_page and cached_page['last_modified'])
+        if page and page.get('not_modified'):
+            # 网页未变化：沿用缓存内容，也不需要重新向量化
+            PAGE_CACHE.set(url, {**cached_page, 'fetched_at': time.time()})
+            return cached_page['text']
+        if not page: return None
+        cleaned_text = extract_text(page['content'], page['encoding'])
+        enqueue_for_indexing(url, cleaned_text, company, lang)
+        if cleaned_text:
+            PAGE_CACHE.set(url, {'text': cleaned_text[:5000], 'etag': page['etag'], 'last_modified': page['last_modified'], 'fetched_at': time.time()})
         return cleaned_text[:5000]
     except Exception as e:
-        print(f"❌ 爬取网站时发生错误: {e}"); return None
+        log_event('scrape_failed', f"❌ 爬取网站时发生错误: {e}", level='warning', url=url, error=str(e))
+        # 重新验证失败时退回缓存中的旧内容，总比没有来源好
+        return cached_page['text'] if cached_page else None
+
+# --- 7.1 并发研究阶段 ---
+# 搜索请求按 SearchPlan 分批并发发出，每个搜索结果一返回就立即开始爬取其中的网页，
+# 同时运行的网络请求数量不超过 RESEARCH_CONCURRENCY。一批搜索全部返回后再向规划器要下一批，
+# 规划器认为来源已经足够时不再搜索。阶段预算用完，或者已经收集到 RESEARCH_TARGET_SOURCES 个
+# 来源且剩余的慢请求在宽限期内仍未返回时，放弃剩余请求。
+RESEARCH_CONCURRENCY = max(1, int(os.getenv("RESEARCH_CONCURRENCY", "8")))
+RESEARCH_TARGET_SOURCES = int(os.getenv("RESEARCH_TARGET_SOURCES", "12"))
+RESEARCH_STRAGGLER_GRACE = float(os.getenv("RESEARCH_STRAGGLER_GRACE", "2"))
+RESEARCH_MAX_PAGES = int(os.getenv("RESEARCH_MAX_PAGES", "30"))  # 单次分析最多爬取的网页数
+SEARCH_TIMEOUT = 15
+
+def run_research_stage(plan, company=None, lang=None, max_workers=RESEARCH_CONCURRENCY, deadline=None, target_sources=RESEARCH_TARGET_SOURCES, executor=None):
+    """并发执行搜索与爬取的生成器：每爬到一个有效网页就产出一个 ('source', ...) 事件，
+    最终返回 (context_blocks, source_map)，调用方用 `yield from` 取得返回值。
+
+    来源编号不按完成顺序分配，而是在全部任务结束后按 (查询发出顺序, 结果排名) 统一分配，
+    因此同样的搜索结果总会得到同样的 [Source ID]，引用逻辑不受并发影响。
+    传入 executor 时 (批量分析) 在共享的线程池中运行，并发上限由调用方统一控制。
+    """
+    search_results = {}  # 查询下标 -> (snippets, sources_data)
+    scraped_texts = {}  # link -> 爬取到的文本 (失败为 None)
+    titles = {}
+
+    deadline = deadline or Deadline(ANALYSIS_DEADLINE_SECONDS)
+    scraped_count, enough_since = 0, None
+    owns_executor = executor is None
+    if owns_executor: executor = ThreadPoolExecutor(max_workers=max_workers)
+    pending = {}
+
+    def submit_next_wave():
+        for index, query, num in plan.next_wave():
+            pending[executor.submit(perform_google_search, query, SEARCH_API_KEY, SEARCH_ENGINE_ID, num_results=num, timeout=deadline.timeout(SEARCH_TIMEOUT))] = ('search', index)
+
+    try:
+        submit_next_wave()
+        while pending:
+            wait_timeout = deadline.remaining()
+            if enough_since is not None: wait_timeout = min(wait_timeout, RESEARCH_STRAGGLER_GRACE - (time.monotonic() - enough_since))
+            if wait_timeout <= 0:
+                log_event('research_abandoned', f"⏱️ 研究阶段{'预算用完' if deadline.expired() else '已收集到足够来源'}，放弃 {len(pending)} 个未完成的请求。", pending=len(pending), deadline_expired=deadline.expired())
+                break
+            done, _ = wait(pending, timeout=wait_timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                kind, key = pending.pop(future)
+                if kind == 'search':
+                    snippets, sources_data = future.result()
+                    search_results[key] = (snippets, sources_data)
+                    plan.record(key, sources_data[:len(snippets)])
+                    log_event('research_search_done', f"✅ 综合查询结果: 查询='{plan.queries[key][1]}', 找到 {len(snippets)} 个片段, {len(sources_data)} 个来源数据", query=plan.queries[key][1], results=len(sources_data))
+                    for source_info in sources_data[:len(snippets)]:
+                        link = source_info.get('link')
+                        if link and link not in scraped_texts and len(scraped_texts) < RESEARCH_MAX_PAGES:
+                            scraped_texts[link] = None
+                            titles[link] = source_info.get('title')
+                            pending[executor.submit(scrape_website_for_text, link, company, lang, deadline.timeout(FETCH_TIMEOUT))] = ('scrape', link)
+                else:
+                    scraped_texts[key] = future.result()
+                    if scraped_texts[key]:
+                        scraped_count += 1
+                        yield 'source', {'title': titles.get(key), 'link': key}
+            if enough_since is None and scraped_count >= target_sources: enough_since = time.monotonic()
+            # 当前这批搜索全部返回后再决定是否需要下一批
+            if enough_since is None and not any(kind == 'search' for kind, _ in pending.values()): submit_next_wave()
+    finally:
+        # 正常结束时所有任务都已完成；客户端中途断开 (生成器被关闭) 时取消尚未开始的任务
+        if owns_executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+        else:
+            for future in pending: future.cancel()
+
+    context_blocks, source_map, source_id_counter = [], {}, 1
+    used_urls = set()
+    for index in sorted(search_results):
+        snippets, sources_data = search_results[index]
+        for i, snippet in enumerate(snippets):
+            if i >= len(sources_data): break
+            source_info = sources_data[i]
+            link = source_info.get('link')
+            scraped_text = scraped_texts.get(link)
+            if not link or link in used_urls or not scraped_text: continue
+            context_blocks.append(f"[Source ID: {source_id_counter}] {scraped_text}")
+            source_map[source_id_counter] = {
+                'title': source_info.get('title'),
+                'link': link,
+                'snippet': snippet
+            }
+            source_id_counter += 1
+            used_urls.add(link)
+
+    log_event('research_done', f"✅ 研究阶段完成: {len(plan.queries)} 个查询 (其中 {plan.upstream_calls} 个未命中缓存), 爬取 {len(scraped_texts)} 个网页, 有效来源 {len(source_map)} 个", queries=len(plan.queries), upstream_calls=plan.upstream_calls, pages=len(scraped_texts), sources=len(source_map))
+    return context_blocks, source_map
+
+# --- 7.2 上下文打包器 ---
+# 后备路径的研究数据不再原样拼接进 Prompt：先把每个来源切成段落，用 MinHash (bottom-k 草图)
+# 去掉各镜像站之间重复的段落，再按与分析维度的相关度排序，在 CONTEXT_TOKEN_BUDGET 内挑选段落。
+# 段落仍按来源归组并保留 [Source ID: X] 标签，引用编号不变；一个段落都没选中的来源不会交给模型。
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "12000"))  # 0 表示不限制
+CONTEXT_PASSAGE_CHARS = int(os.getenv("CONTEXT_PASSAGE_CHARS", "600"))
+CONTEXT_DUPLICATE_THRESHOLD = float(os.getenv("CONTEXT_DUPLICATE_THRESHOLD", "0.7"))  # 估计 Jaccard 相似度超过此值视为重复
+MINHASH_SIZE = 64
+SHINGLE_WORDS = 5
+
+_SOURCE_BLOCK_RE = re.compile(r'^\[Source ID: (\d+)\] ', re.S)
+_WORD_RE = re.compile(r'\w+')
+_NON_ASCII_RE = re.compile(r'[^\x00-\x7f]')
+_ASPECT_STOPWORDS = {'and', 'or', 'the', 'of', 'company', 'review', 'reviews'}
+
+def estimate_tokens(text):
+    """粗略估算 token 数：ASCII 约 4 个字符一个 token，中日韩等非 ASCII 字符按 1 个 token 计。"""
+    non_ascii = len(_NON_ASCII_RE.findall(text))
+    return (len(text) - non_ascii) // 4 + non_ascii
+
+def minhash_signature(text):
+    """返回由 SHINGLE_WORDS 词 shingle 的哈希值中最小的 MINHASH_SIZE 个组成的草图 (bottom-k MinHash)。"""
+    words = _WORD_RE.findall(text.casefold())
+    shingles = {' '.join(words[i:i + SHINGLE_WORDS]) for i in range(max(1, len(words) - SHINGLE_WORDS + 1))}
+    hashes = {int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(), 'big') for shingle in shingles}
+    return frozenset(sorted(hashes)[:MINHASH_SIZE])
+
+def estimate_jaccard(a, b):
+    # bottom-k 估计：取并集中最小的 k 个哈希，统计其中同时出现在两个草图里的比例
+    union_bottom = sorted(a | b)[:MINHASH_SIZE]
+    return sum(1 for h in union_bottom if h in a and h in b) / len(union_bottom) if union_bottom else 0.0
+
+def _aspect_terms(aspects):
+    return {term for aspect in aspects for term in _WORD_RE.findall(aspect.casefold()) if term not in _ASPECT_STOPWORDS}
+
+def pack_research_context(context_blocks, aspects, token_budget=None):
+    """对研究阶段产出的 context_blocks 去重、排序并按 token 预算打包。
+    返回 (packed_blocks, packed_source_ids, stats)，packed_blocks 中每个来源的段落按原文顺序排列。"""
+    token_budget = CONTEXT_TOKEN_BUDGET if token_budget is None else token_budget
+    passages = []  # (source_id, 段落序号, 文本)
+    for block in context_blocks:
+        match = _SOURCE_BLOCK_RE.match(block)
+        if not match: continue
+        source_id = int(match.group(1))
+        for i, passage in enumerate(chunk_text(block[match.end():], chunk_size=CONTEXT_PASSAGE_CHARS, overlap=0)):
+            if passage.strip(): passages.append((source_id, i, passage))
+    original_tokens = sum(estimate_tokens(block) for block in context_blocks)
+
+    # 1. 近似去重：按来源编号顺序处理，编号靠前 (查询排名更高) 的段落优先保留。
+    #    倒排索引只比较至少共享一个草图哈希的段落，避免两两比较全部段落。
+    kept, signatures, postings, duplicates = [], [], {}, 0
+    for passage in passages:
+        signature = minhash_signature(passage[2])
+        candidates = {j for h in signature for j in postings.get(h, ())}
+        if any(estimate_jaccard(signature, signatures[j]) >= CONTEXT_DUPLICATE_THRESHOLD for j in candidates):
+            duplicates += 1
+            continue
+        for h in signature: postings.setdefault(h, []).append(len(kept))
+        kept.append(passage)
+        signatures.append(signature)
+
+    # 2. 相关度：分析维度关键词的 BM25 式打分 (词频饱和 × 逆文档频率)
+    terms = _aspect_terms(aspects)
+    tokenized = [_WORD_RE.findall(passage[2].casefold()) for passage in kept]
+    document_frequency = {term: sum(1 for words in tokenized if term in words) for term in terms}
+    idf = {term: math.log(1 + (len(kept) - df + 0.5) / (df + 0.5)) for term, df in document_frequency.items()}
+    scores = []
+    for words in tokenized:
+        counts = {term: words.count(term) for term in terms}
+        scores.append(sum(idf[term] * tf * 2.2 / (tf + 1.2) for term, tf in counts.items() if tf))
+
+    # 3. 预算内选择：先保证每个来源最相关的段落入选，再按得分补充其余段落；同分时编号靠前者优先
+    order = sorted(range(len(kept)), key=lambda j: (-scores[j], kept[j][0], kept[j][1]))
+    best_per_source = {}
+    for j in order: best_per_source.setdefault(kept[j][0], j)
+    first_round = set(best_per_source.values())
+    selected, used_tokens = set(), 0
+    for j in [j for j in order if j in first_round] + [j for j in order if j not in first_round]:
+        cost = estimate_tokens(kept[j][2]) + 8  # 8 ≈ 来源标签与分隔符
+        if token_budget and used_tokens + cost > token_budget: continue
+        selected.add(j)
+        used_tokens += cost
+
+    by_source = OrderedDict()
+    for j in sorted(selected, key=lambda j: (kept[j][0], kept[j][1])):
+        by_source.setdefault(kept[j][0], []).append(kept[j][2])
+    packed_blocks = [f"[Source ID: {source_id}] " + "\n...\n".join(texts) for source_id, texts in by_source.items()]
+    packed_tokens = sum(estimate_tokens(block) for block in packed_blocks)
+    stats = {
+        'original_tokens': original_tokens, 'packed_tokens': packed_tokens, 'tokens_saved': max(0, original_tokens - packed_tokens),
+        'passages': len(passages), 'duplicates_removed': duplicates, 'passages_selected': len(selected),
+        'sources_selected': len(by_source),
+    }
+    CONTEXT_TOKENS_SAVED.inc(stats['tokens_saved'])
+    log_event('context_packed', f"✂️ 上下文打包: {original_tokens} → {packed_tokens} tokens (节省 {stats['tokens_saved']}), "
+              f"去除重复段落 {duplicates} 个, 选中 {len(selected)}/{len(passages)} 个段落, 覆盖 {len(by_source)}/{len(context_blocks)} 个来源", **stats)
+    return packed_blocks, set(by_source), stats
 
 # --- 8. 多语言Prompt指令核心 ---
 PROMPTS = {
@@ -308,189 +1903,683 @@ def scrub_invalid_citations(data, valid_ids_set):
 
 
 
+# --- 9.1 分析结果缓存 ---
+# 缓存键由规范化后的公司名、职位、地点、语言以及简历文本的哈希组成，
+# 因此请求体中的空白、字段顺序等差异不会导致缓存未命中。
+# 默认使用本地 SQLite 文件 (跨 Worker 共享、重启后仍然有效)，带 TTL 与 LRU 淘汰；
+# 设置了 REDIS_URL 时默认使用 Redis，多个实例共享同一份缓存。
+ANALYSIS_CACHE_BACKEND = os.getenv("ANALYSIS_CACHE_BACKEND", "redis" if REDIS_URL else "sqlite")  # sqlite | memory | redis
+ANALYSIS_CACHE_PATH = os.getenv("ANALYSIS_CACHE_PATH", os.path.join(tempfile.gettempdir(), "project_lens_cache.sqlite3"))
+ANALYSIS_CACHE_TTL = int(os.getenv("ANALYSIS_CACHE_TTL", "43200"))  # 12 hours in seconds
+ANALYSIS_CACHE_MAX_ENTRIES = int(os.getenv("ANALYSIS_CACHE_MAX_ENTRIES", "2000"))
+
+class CacheBackend:
+    """缓存后端接口：值为可 JSON 序列化的对象，过期或不存在时 get 返回 None。"""
+    def get(self, key): raise NotImplementedError
+    def set(self, key, value, ttl): raise NotImplementedError
+
+class MemoryCacheBackend(CacheBackend):
+    """进程内 LRU 缓存，主要用于测试和没有可写磁盘的环境。"""
+    def __init__(self, max_entries=ANALYSIS_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None: return None
+            expires_at, value = entry
+            if expires_at < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (time.time() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries: self._entries.popitem(last=False)
+
+class SQLiteCacheBackend(CacheBackend):
+    """本地 SQLite 持久化缓存。每次操作使用独立连接，多线程、多 Worker 进程可以安全共享同一个文件。"""
+    def __init__(self, path=ANALYSIS_CACHE_PATH, max_entries=ANALYSIS_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, accessed_at REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache (accessed_at)")
+
+    def _connect(self):
+        return closing(sqlite3.connect(self.path, timeout=5, isolation_level=None))
+
+    def get(self, key):
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute("SELECT value, expires_at FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None: return None
+            if row[1] < now:
+                conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                return None
+            conn.execute("UPDATE cache SET accessed_at = ? WHERE key = ?", (now, key))
+            return json.loads(row[0])
+
+    def set(self, key, value, ttl):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO cache (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)", (key, json.dumps(value, ensure_ascii=False), now + ttl, now))
+            conn.execute("DELETE FROM cache WHERE expires_at < ?", (now,))
+            # LRU 淘汰：只保留最近访问的 max_entries 条
+            conn.execute("DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+
+class RedisCacheBackend(CacheBackend):
+    """Redis 共享缓存，供多 Worker、多实例部署使用。过期由 Redis 的 TTL 处理，容量淘汰交给 maxmemory-policy。"""
+    def __init__(self, url=None, prefix='project_lens:'):
+        if not (url or REDIS_URL): raise ValueError("REDIS_URL 未设置")
+        self.client = get_redis(url)
+        self.prefix = prefix
+        self.client.ping()
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return json.loads(value) if value is not None else None
+
+    def set(self, key, value, ttl):
+        self.client.set(self.prefix + key, json.dumps(value, ensure_ascii=False), ex=int(ttl))
+
+CACHE_BACKENDS = {'sqlite': SQLiteCacheBackend, 'memory': MemoryCacheBackend, 'redis': RedisCacheBackend}
+
+class AnalysisCache:
+    """在缓存后端外包一层：后端出错只记录日志，绝不影响分析请求本身。"""
+    def __init__(self, backend, ttl=ANALYSIS_CACHE_TTL):
+        self.backend = backend
+        self.ttl = ttl
+
+    def get(self, key):
+        try:
+            return self.backend.get(key)
+        except Exception as e:
+            log_event('analysis_cache_read_failed', f"⚠️ 读取分析缓存失败: {e}", level='warning', error=str(e))
+            return None
+
+    def set(self, key, value):
+        try:
+            self.backend.set(key, value, self.ttl)
+        except Exception as e:
+            log_event('analysis_cache_write_failed', f"⚠️ 写入分析缓存失败: {e}", level='warning', error=str(e))
+
+def _create_cache_backend(name):
+    try:
+        return CACHE_BACKENDS[name]()
+    except Exception as e:
+        log_event('analysis_cache_fallback', f"⚠️ 无法初始化 {name} 缓存后端 ({e})，改用进程内缓存。", level='warning', backend=name, error=str(e))
+        return MemoryCacheBackend()
+
+analysis_cache = AnalysisCache(_create_cache_backend(ANALYSIS_CACHE_BACKEND))
+
+def _normalize_field(value):
+    return re.sub(r'\s+', ' ', (value or '').casefold()).strip()
+
+def build_analysis_cache_key(company_name, job_title, location, lang, resume_text):
+    resume_hash = hashlib.sha256(_normalize_field(resume_text).encode('utf-8')).hexdigest()
+    normalized = [normalize_company_name(company_name), _normalize_field(job_title), _normalize_field(location), lang, resume_hash]
+    return 'analysis:v1:' + hashlib.sha256(json.dumps(normalized, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+# --- 9.2 分析流水线 ---
+# /analyze 与 /analyze/stream 共用同一条流水线。流水线是一个生成器，依次产出
+# (event, payload) 事件：stage (阶段进度)、entities、source (发现新来源)、sources (最终编号的来源)、
+# token (流式生成的报告片段)，最后以 result 事件给出与 /analyze 响应体相同的结果。
+SUPPORTED_LANGS = ['en', 'zh-CN', 'zh-TW']
+RESEARCH_ASPECTS = [aspect for group in RESEARCH_QUERY_GROUPS.values() for aspect in group['aspects']]
+GENERATION_MODEL = 'models/gemini-2.5-pro'
+GENERATION_FALLBACK_MODEL = os.getenv("GENERATION_FALLBACK_MODEL", "models/gemini-2.5-flash")
+GENERATION_PRIMARY_SHARE = float(os.getenv("GENERATION_PRIMARY_SHARE", "0.7"))  # 主模型可用的生成预算比例，其余留给后备模型
+GENERATION_MIN_SECONDS = float(os.getenv("GENERATION_MIN_SECONDS", "10"))
+RESEARCH_BUDGET_SHARE = float(os.getenv("RESEARCH_BUDGET_SHARE", "0.5"))
+ENTITY_TIMEOUT_SECONDS = 20
+RAG_LOOKUP_TIMEOUT_SECONDS = 10
+def generation_timeout_errors():
+    """生成调用的超时与过载异常。gRPC 传输超时抛出 DeadlineExceeded；gevent 下使用的 REST 传输超时抛出 requests 的 Timeout。
+    写成函数是为了让 except 子句在真正捕获异常时才导入 google.api_core (以及 grpc)。"""
+    return (google_exceptions.DeadlineExceeded, google_exceptions.ServiceUnavailable, google_exceptions.ResourceExhausted, google_exceptions.RetryError, TimeoutError, requests.exceptions.Timeout)
+FALLBACK_SAFETY_SETTINGS = { category: "BLOCK_NONE" for category in ["HARM_CATEGORY_HARASSMENT", "HARM_CATEGORY_HATE_SPEECH", "HARM_CATEGORY_SEXUALLY_EXPLICIT", "HARM_CATEGORY_DANGEROUS_CONTENT"]}
+
+class AnalysisError(Exception):
+    """流水线中可预期的失败，携带返回给客户端的错误类型、消息和 HTTP 状态码。"""
+    def __init__(self, error_type, message, status_code):
+        super().__init__(message)
+        self.error_type = error_type
+        self.message = message
+        self.status_code = status_code
+
+def parse_analysis_request(data):
+    if not data: raise AnalysisError("invalid_json", "Request body is not valid JSON.", 400)
+    user_query = data.get('companyName')
+    if not user_query: raise AnalysisError("missing_parameter", "Company name is required.", 400)
+    lang = data.get('lang', 'zh-CN')
+    if lang not in SUPPORTED_LANGS:
+        lang = 'zh-CN'
+    return { 'user_query': user_query, 'lang': lang, 'resume_text': data.get('resumeText', 'No resume provided.') }
+
+def format_sse(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+def _generate_text(model, prompt, stream_tokens, **kwargs):
+    """调用 generate_content 并返回完整文本 (被安全策略拦截时返回 None)。
+    stream_tokens 为 True 时使用流式生成，并把每个片段作为 token 事件产出。"""
+    span_name = 'generate_' + getattr(model, 'model_name', 'model').rsplit('/', 1)[-1]
+    if not stream_tokens:
+        with timed_span(span_name):
+            response = model.generate_content(prompt, **kwargs)
+        return response.text if response.parts else None
+    parts = []
+    with timed_span(span_name, stream=True):
+        for chunk in model.generate_content(prompt, stream=True, **kwargs):
+            if not chunk.parts: continue
+            parts.append(chunk.text)
+            yield 'token', {'text': chunk.text}
+    return ''.join(parts) if parts else None
+
+def _generate_with_fallback(prompt, deadline, stream_tokens, **kwargs):
+    """在生成预算内调用主模型；主模型超时或过载时，用剩余预算改由后备模型重试一次。
+    返回 (文本, 实际使用的模型)，结果中的 generation_model 字段让调用方知道是否发生了降级。"""
+    if deadline.remaining() < GENERATION_MIN_SECONDS:
+        raise AnalysisError("deadline_exceeded", "The analysis ran out of time before report generation. Please try again.", 504)
+    primary_timeout = deadline.remaining() * (GENERATION_PRIMARY_SHARE if GENERATION_FALLBACK_MODEL else 1.0)
+    try:
+        return (yield from _generate_text(get_model(GENERATION_MODEL), prompt, stream_tokens, request_options={'timeout': primary_timeout}, **kwargs)), GENERATION_MODEL
+    except generation_timeout_errors() as e:
+        if not GENERATION_FALLBACK_MODEL or deadline.remaining() < GENERATION_MIN_SECONDS: raise
+        log_event('generation_fallback', f"⏱️ {GENERATION_MODEL} 在 {primary_timeout:.0f} 秒内未完成 ({type(e).__name__})，改用 {GENERATION_FALLBACK_MODEL} 重试。", level='warning', model=GENERATION_MODEL, fallback_model=GENERATION_FALLBACK_MODEL, error=type(e).__name__)
+        # 流式模式下客户端需要丢弃已收到的 token，从头接收后备模型的输出
+        yield 'stage', {'stage': 'generation', 'model': GENERATION_FALLBACK_MODEL, 'retry': True}
+        return (yield from _generate_text(get_model(GENERATION_FALLBACK_MODEL), prompt, stream_tokens, request_options={'timeout': deadline.timeout()}, **kwargs)), GENERATION_FALLBACK_MODEL
+
+def _rag_source_label(metadata, i):
+    if metadata.get('source_type') == 'web_scrape':
+        try:
+            domain = metadata['source_url'].split('/')[2]
+            date = metadata['scraped_at'].split('T')[0]
+            return f"{domain} ({date})"
+        except:
+            return "Web Scrape"
+    return metadata.get('label', f"Source {i}")
+
+def run_analysis_pipeline(analysis_request, stream_tokens=False, research_executor=None):
+    """对流水线计时并按路径计数：命中分析缓存为 cache，生成阶段前失败为 none，其余为 rag / fallback。"""
+    path, outcome = 'cache', 'ok'
+    finished = False
+    started = time.perf_counter()
+    try:
+        for event, payload in _run_analysis_pipeline(analysis_request, stream_tokens, research_executor):
+            if event == 'stage' and payload.get('path'): path = payload['path']
+            finished = finished or event == 'result'
+            yield event, payload
+    except AnalysisError as e:
+        outcome = e.error_type
+        if path == 'cache': path = 'none'
+        raise
+    except GeneratorExit:
+        # 调用方拿到结果后关闭生成器属于正常结束，之前关闭说明客户端已断开
+        if not finished: outcome = 'cancelled'
+        raise
+    except Exception:
+        outcome = 'error'
+        if path == 'cache': path = 'none'
+        raise
+    finally:
+        ANALYSIS_DURATION.observe(time.perf_counter() - started, path=path, outcome=outcome)
+        ANALYSES_TOTAL.inc(path=path, outcome=outcome)
+
+def _run_analysis_pipeline(analysis_request, stream_tokens=False, research_executor=None):
+    user_query, lang = analysis_request['user_query'], analysis_request['lang']
+    deadline = Deadline(ANALYSIS_DEADLINE_SECONDS)
+
+    # 实体提取放在 RAG 之前：向量检索需要按公司名过滤，后备路径也需要这些实体
+    yield 'stage', {'stage': 'entity_extraction'}
+    try:
+        company_name, job_title, location = extract_entities_with_ai(user_query, deadline=deadline.slice(1.0, cap=ENTITY_TIMEOUT_SECONDS))
+    except generation_timeout_errors() as e:
+        log_event('entity_extraction_timeout', f"!!! 实体提取AI调用超时: {e} !!!", level='error', error=str(e))
+        raise AnalysisError("deadline_exceeded", "Entity extraction did not finish within the time budget. Please try again.", 504)
+    except Exception as e:
+        log_event('entity_extraction_failed', f"!!! 实体提取AI调用失败: {e} !!!", level='error', exc_info=True)
+        error_message = f"AI entity extraction failed. Error: {type(e).__name__}. This might be a problem with the Generative Language API permissions or billing. Please ensure the model 'models/gemini-2.5-pro' is available for your project."
+        raise AnalysisError("ai_entity_extraction_error", error_message, 500)
+
+    if not company_name: raise AnalysisError("entity_extraction_failed", "Could not identify company name from input.", 400)
+    yield 'entities', {'company_name': company_name, 'job_title': job_title, 'location': location}
+
+    cache_key = build_analysis_cache_key(company_name, job_title, location, lang, analysis_request['resume_text'])
+    cached_payload = analysis_cache.get(cache_key)
+    if cached_payload:
+        log_event('analysis_cache_hit', f"⚡ 命中分析缓存: 公司='{company_name}', 语言='{lang}'", company=company_name, lang=lang)
+        yield 'result', cached_payload
+        return
+
+    # RAG Step 1: Query VectorDB (只在该公司的文档块中检索)
+    if PINECONE_INDEX or LOCAL_VECTOR_INDEX:
+        try:
+            yield 'stage', {'stage': 'rag_search'}
+            log_event('rag_search', f"🔍 Performing RAG search for: '{user_query}'", query=user_query)
+            query_vector = embed_query(user_query, timeout=deadline.timeout(RAG_LOOKUP_TIMEOUT_SECONDS))
+
+            # 只保留足够相关的结果 (score > RAG_MIN_SCORE)
+            relevant_matches, index_used = query_vector_indexes(query_vector, 5, {'company': {'$eq': normalize_company_name(company_name)}}, deadline.timeout(RAG_LOOKUP_TIMEOUT_SECONDS))
+
+            if relevant_matches:
+                log_event('rag_hit', f"✅ Found {len(relevant_matches)} relevant documents in the {index_used} vector index.", matches=len(relevant_matches), index=index_used)
+
+                context_chunks = []
+                sources_for_frontend = []
+                for i, match in enumerate(relevant_matches, 1):
+                    metadata = match['metadata']
+                    snippet = metadata.get('snippet', '')
+                    context_chunks.append(f"[{i}] {snippet}")
+                    # Prepare sources for frontend
+                    sources_for_frontend.append({
+                        'id': i,
+                        'title': _rag_source_label(metadata, i),
+                        'link': metadata.get('source_url', '#'),
+                        'source_type': metadata.get('source_type', 'default'),
+                        'snippet': snippet
+                    })
+                yield 'sources', {'sources': sources_for_frontend}
+
+                # RAG Step 2: Generate Answer from Context
+                yield 'stage', {'stage': 'generation', 'path': 'rag'}
+                rag_prompt = PROMPTS[lang]['rag_prompt'].format(context_text="\n\n".join(context_chunks), user_query=user_query)
+                PROMPT_TOKENS.observe(estimate_tokens(rag_prompt), path='rag')
+                answer, generation_model = yield from _generate_with_fallback(rag_prompt, deadline, stream_tokens)
+                if answer is None: raise ValueError("RAG generation returned no content")
+
+                # RAG Step 3: Format Response
+                payload = {
+                    "answer": answer,
+                    "sources": sources_for_frontend,
+                    "company_name": user_query,
+                    "generation_model": generation_model
+                }
+                analysis_cache.set(cache_key, payload)
+                yield 'result', payload
+                return
+
+        except AnalysisError:
+            raise
+        except Exception as e:
+            log_event('rag_failed', f"❌ RAG search failed: {e}", level='error', error=str(e))
+            # Proceed to fallback logic
+
+    if deadline.remaining() < GENERATION_MIN_SECONDS:
+        raise AnalysisError("deadline_exceeded", "The analysis ran out of time before web research could start. Please try again.", 504)
+
+    log_event('rag_miss', "⚠️ Vector search did not yield sufficient results. Falling back to web scraping.")
+    # Fallback logic (original implementation)
+    search_plan = SearchPlan(company_name, location)
+    yield 'stage', {'stage': 'research', 'queries': len(RESEARCH_QUERY_GROUPS)}
+    context_blocks, source_map = yield from run_research_stage(search_plan, company=company_name, lang=lang, deadline=deadline.slice(RESEARCH_BUDGET_SHARE), executor=research_executor)
+
+    if not context_blocks and search_plan.quota_exhausted: raise AnalysisError("search_quota_exhausted", "The daily web search quota has been used up. Please try again tomorrow.", 503)
+    if not context_blocks: raise AnalysisError("no_info_found", "No information found for this company. This might be due to the company being very new, very small, or the search query being too specific. Please try a broader search term.", 404)
+    # 只把实际打包进 Prompt 的来源交给前端和引用净化，模型无法引用被整段丢弃的来源
+    packed_blocks, packed_source_ids, packing_stats = pack_research_context(context_blocks, RESEARCH_ASPECTS)
+    source_map = {sid: source for sid, source in source_map.items() if sid in packed_source_ids}
+    yield 'sources', {'sources': [ {**source, 'id': sid} for sid, source in source_map.items() ]}
+
+    full_prompt = PROMPTS[lang]['fallback_prompt'].format(company_name=company_name, job_title=job_title, location=location or "Not Specified", current_date=datetime.date.today().strftime("%Y-%m-%d"), resume_text=analysis_request['resume_text'], context_with_sources="\n\n".join(packed_blocks))
+
+    PROMPT_TOKENS.observe(estimate_tokens(full_prompt), path='fallback')
+    yield 'stage', {'stage': 'generation', 'path': 'fallback', 'context_tokens': packing_stats['packed_tokens'], 'tokens_saved': packing_stats['tokens_saved']}
+    try:
+        response_text, generation_model = yield from _generate_with_fallback(full_prompt, deadline, stream_tokens, generation_config=genai.GenerationConfig(response_mime_type="application/json"), safety_settings=FALLBACK_SAFETY_SETTINGS)
+    except AnalysisError:
+        raise
+    except generation_timeout_errors() as e:
+        log_event('generation_timeout', f"!!! 核心分析AI调用超时: {e} !!!", level='error', error=str(e))
+        raise AnalysisError("deadline_exceeded", "Report generation did not finish within the time budget. Please try again.", 504)
+    except Exception as e:
+        log_event('generation_failed', f"!!! 核心分析AI调用失败: {e} !!!", level='error', exc_info=True)
+        error_message = f"Main AI analysis call failed. Error: {type(e).__name__}. This could be due to API permissions, billing, or an issue with the content sent for analysis."
+        raise AnalysisError("ai_analysis_error", error_message, 500)
+
+    if response_text is None: raise AnalysisError("ai_response_blocked", "AI content generation was blocked by safety settings.", 500)
+
+    try:
+        ai_json_response = json.loads(response_text)
+        report_data = ai_json_response.get("report", {})
+
+        # --- RAG 修复逻辑 ---
+        all_mentioned_ids = extract_all_mentioned_ids(report_data)
+        valid_ids_set = all_mentioned_ids.intersection(source_map.keys())
+        scrubbed_report_data = scrub_invalid_citations(report_data, valid_ids_set)
+        # [最终修复] 将有效的 [ID] 标记转换为可点击的 Markdown 锚点链接
+        final_report_data = scrubbed_report_data
+
+    except json.JSONDecodeError:
+        log_event('generation_malformed_json', f"!!! AI returned malformed JSON: {response_text} !!!", level='error', response_text=response_text)
+        raise AnalysisError("ai_malformed_json", "AI failed to generate a valid JSON report.", 500)
+
+    final_sources = [ {**source_map[sid], 'id': sid} for sid in sorted(list(valid_ids_set)) if sid in source_map ]
+    payload = {"company_name": company_name, "answer": final_report_data, "sources": final_sources, "generation_model": generation_model}
+    analysis_cache.set(cache_key, payload)
+    yield 'result', payload
+
+# --- 9.3 异步任务与单飞合并 ---
+# POST /analyze/jobs 立即返回任务 ID，流水线在后台线程池中执行，HTTP 线程不再被长时间占用。
+# 同一时刻针对同一规范化输入的多个任务共享一次流水线执行 (single-flight)，
+# 热门公司的突发流量不会重复消耗搜索额度和模型调用。已结束的任务按数量和时间有界保留。
+JOB_WORKERS = max(1, int(os.getenv("JOB_WORKERS", "4")))
+JOB_MAX_RETAINED = int(os.getenv("JOB_MAX_RETAINED", "500"))
+JOB_RETENTION_SECONDS = int(os.getenv("JOB_RETENTION_SECONDS", "3600"))
+
+_job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='analysis-job')
+_jobs = OrderedDict()  # job_id -> {'future', 'created_at'}
+_inflight_jobs = {}    # 规范化请求键 -> 正在执行的 future
+_jobs_lock = threading.RLock()
+
+def build_request_key(analysis_request):
+    """单飞合并发生在实体提取之前，因此直接用规范化后的原始输入作为键。"""
+    normalized = [_normalize_field(analysis_request['user_query']), analysis_request['lang'], _normalize_field(analysis_request['resume_text'])]
+    return hashlib.sha256(json.dumps(normalized, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+def _run_pipeline_to_result(analysis_request, research_executor=None):
+    for event, payload in run_analysis_pipeline(analysis_request, research_executor=research_executor):
+        if event == 'result': return payload
+    raise AnalysisError("internal_server_error", "Analysis pipeline finished without a result.", 500)
+
+def _release_inflight_job(key, future):
+    with _jobs_lock:
+        if _inflight_jobs.get(key) is future: del _inflight_jobs[key]
+
+def _prune_jobs():
+    expire_before = time.time() - JOB_RETENTION_SECONDS
+    for job_id, job in list(_jobs.items()):
+        if len(_jobs) <= JOB_MAX_RETAINED and job['created_at'] >= expire_before: break
+        # 超出容量时即使任务还在运行也移除记录，流水线本身会继续执行并写入分析缓存
+        if job['future'].done() or len(_jobs) > JOB_MAX_RETAINED: del _jobs[job_id]
+
+def submit_analysis_job(analysis_request):
+    """提交分析任务，返回 (job_id, coalesced)。coalesced 为 True 表示复用了正在执行的相同任务。"""
+    key = build_request_key(analysis_request)
+    with _jobs_lock:
+        _prune_jobs()
+        future = _inflight_jobs.get(key)
+        coalesced = future is not None
+        if not coalesced:
+            future = _job_executor.submit(_run_pipeline_to_result, analysis_request)
+            _inflight_jobs[key] = future
+            future.add_done_callback(lambda f: _release_inflight_job(key, f))
+        job_id = uuid.uuid4().hex
+        _jobs[job_id] = {'future': future, 'created_at': time.time()}
+    if coalesced: log_event('job_coalesced', f"🔗 合并到正在执行的相同分析任务: {analysis_request['user_query']}", query=analysis_request['user_query'])
+    return job_id, coalesced
+
+def get_analysis_job(job_id):
+    """返回任务状态字典；任务不存在或已过期时返回 None。"""
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+    if job is None: return None
+    future = job['future']
+    status = { 'job_id': job_id, 'created_at': datetime.datetime.utcfromtimestamp(job['created_at']).isoformat() + "Z" }
+    if not future.done():
+        status['status'] = 'running' if future.running() else 'queued'
+        return status
+    status.update(_future_outcome(future))
+    return status
+
+def _future_outcome(future):
+    """把已完成的流水线 future 转成 {'status': 'succeeded', 'result'} 或 {'status': 'failed', 'error'}。"""
+    error = future.exception()
+    if error is None: return {'status': 'succeeded', 'result': future.result()}
+    if isinstance(error, AnalysisError):
+        return {'status': 'failed', 'error': {'error': error.error_type, 'message': error.message, 'status': error.status_code}}
+    log_event('job_failed', f"!!! 分析任务发生未知错误: {error} !!!", level='error', error=str(error))
+    return {'status': 'failed', 'error': {'error': "internal_server_error", 'message': "An unexpected error occurred. Please check server logs for details.", 'status': 500}}
+
+# --- 9.4 批量分析 ---
+# 一次提交多条公司/职位记录 (HTTP 或命令行)。完全相同的记录只分析一次；所有记录的研究阶段共用一个
+# 线程池 (BATCH_RESEARCH_CONCURRENCY)，相同的搜索查询和网页由 SingleFlight 与阶段缓存在记录之间共享；
+# 查询向量在开始前一次性批量生成，爬到的网页照常由后台索引器批量向量化。每条记录完成即输出结果。
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "5"))
+BATCH_CONCURRENCY = max(1, int(os.getenv("BATCH_CONCURRENCY", "4")))
+BATCH_RESEARCH_CONCURRENCY = max(1, int(os.getenv("BATCH_RESEARCH_CONCURRENCY", "16")))
+
+def parse_batch_records(body, max_items=BATCH_MAX_ITEMS):
+    """解析批量输入：JSON 数组、{"items": [...]}，或每行一个 JSON 对象的 NDJSON / JSONL。"""
+    text = (body.decode('utf-8', errors='replace') if isinstance(body, bytes) else body).strip()
+    if not text: raise AnalysisError("invalid_json", "Request body is empty.", 400)
+    try:
+        data = json.loads(text)
+        records = data.get('items', [data]) if isinstance(data, dict) else data
+    except json.JSONDecodeError:
+        records = []
+        for line_number, line in enumerate(text.splitlines(), 1):
+            if not line.strip(): continue
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                raise AnalysisError("invalid_json", f"Line {line_number} is not valid JSON.", 400)
+    if not isinstance(records, list) or not records: raise AnalysisError("invalid_json", "Expected a non-empty list of records.", 400)
+    if max_items and len(records) > max_items: raise AnalysisError("batch_too_large", f"A batch may contain at most {max_items} records.", 413)
+    return records
+
+def batch_rate_limit_cost():
+    """每条记录都计入 /analyze 的共享限额；无法解析的请求体按 1 次计算 (随后由路由返回 400)。"""
+    try:
+        return len(parse_batch_records(request.get_data()))
+    except AnalysisError:
+        return 1
+
+def batch_record_to_request(record):
+    """记录可以使用 /analyze 的字段 (companyName / lang / resumeText)，也可以是招聘网站导出的
+    company / job_title (或 title) / location，后者拼成 "职位 at 公司, 地点"，通常由规则层直接解析。"""
+    if not isinstance(record, dict): raise AnalysisError("invalid_record", "Each record must be a JSON object.", 400)
+    if not record.get('companyName') and record.get('company'):
+        job_title, location = record.get('job_title') or record.get('title'), record.get('location')
+        user_query = f"{job_title} at {record['company']}" if job_title else record['company']
+        record = {**record, 'companyName': f"{user_query}, {location}" if location else user_query}
+    return parse_analysis_request(record)
+
+def run_batch(records, concurrency=BATCH_CONCURRENCY, research_concurrency=BATCH_RESEARCH_CONCURRENCY):
+    """批量分析生成器：按完成顺序为每条记录产出 {'index', 'id', 'status', 'result' / 'error'}。"""
+    groups = OrderedDict()  # 规范化请求键 -> (analysis_request, [(index, id)])
+    for index, record in enumerate(records):
+        record_id = record.get('id', record.get('request_id')) if isinstance(record, dict) else None
+        try:
+            analysis_request = batch_record_to_request(record)
+        except AnalysisError as e:
+            yield {'index': index, 'id': record_id, 'status': 'failed', 'error': {'error': e.error_type, 'message': e.message, 'status': e.status_code}}
+            continue
+        groups.setdefault(build_request_key(analysis_request), (analysis_request, []))[1].append((index, record_id))
+    if not groups: return
+    log_event('batch_start', f"📦 批量分析: {len(records)} 条记录, 去重后 {len(groups)} 个分析任务", records=len(records), analyses=len(groups))
+
+    try:
+        embed_queries([analysis_request['user_query'] for analysis_request, _ in groups.values()])
+    except Exception as e:
+        log_event('batch_embed_failed', f"⚠️ 批量生成查询向量失败: {e}，将在各条记录中单独生成。", level='warning', error=str(e))
+
+    research_executor = ThreadPoolExecutor(max_workers=research_concurrency, thread_name_prefix='batch-research')
+    item_executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='batch-item')
+    futures = {}
+    try:
+        futures = { item_executor.submit(_run_pipeline_to_result, analysis_request, research_executor): targets for analysis_request, targets in groups.values() }
+        for future in as_completed(futures):
+            outcome = _future_outcome(future)
+            for index, record_id in futures[future]:
+                yield {'index': index, 'id': record_id, **outcome}
+    finally:
+        # 调用方提前停止 (客户端断开) 时取消尚未开始的记录；正在运行的记录会执行完并写入缓存。
+        # 它们还会向研究线程池提交任务，所以研究线程池要等它们结束后再关闭，等待放在后台线程里，不阻塞调用方
+        item_executor.shutdown(wait=False, cancel_futures=True)
+        if all(future.done() for future in futures):
+            research_executor.shutdown(wait=False)
+        else:
+            threading.Thread(target=_shutdown_batch_executors, args=(item_executor, research_executor), name='batch-shutdown', daemon=True).start()
+
+def _shutdown_batch_executors(item_executor, research_executor):
+    item_executor.shutdown(wait=True)
+    research_executor.shutdown(wait=False)
+
 # --- 10. API路由 (已更新) ---
+@app.before_request
+def _mark_request_start():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def _record_first_request(response):
+    # 健康检查和就绪探针不算作第一个请求
+    if request.endpoint not in ('health_check', 'readiness_probe', 'metrics') and 'request_started' in g:
+        record_first_request(time.perf_counter() - g.request_started)
+    return response
+
 @app.route('/', methods=['GET'])
 def health_check():
     key_status = { "GEMINI_API_KEY": "配置成功" if GEMINI_API_KEY else "缺失", "SEARCH_API_KEY": "配置成功" if SEARCH_API_KEY else "缺失", "SEARCH_ENGINE_ID": "配置成功" if SEARCH_ENGINE_ID else "缺失" }
     status_message = "服务运行正常" if all([GEMINI_API_KEY, SEARCH_API_KEY, SEARCH_ENGINE_ID]) else "警告：API密钥配置不完整，核心功能将无法使用"
-    return jsonify({ "service_name": "Project Lens Backend", "status": status_message, "timestamp": datetime.datetime.utcnow().isoformat() + "Z", "api_keys_status": key_status }), 200
+    stage_caches = { stage_cache.name: stage_cache.stats() for stage_cache in STAGE_CACHES }
+    return jsonify({ "service_name": "Project Lens Backend", "status": status_message, "timestamp": datetime.datetime.utcnow().isoformat() + "Z", "api_keys_status": key_status, "stage_caches": stage_caches, "open_circuits": DOMAIN_BREAKER.open_hosts(), "entity_extraction_tiers": dict(ENTITY_TIER_COUNTS), "search_quota": CSE_QUOTA.stats(), "vector_index": { "pinecone": bool(PINECONE_INDEX), "local": LOCAL_VECTOR_INDEX.stats() if LOCAL_VECTOR_INDEX else None }, "startup": { "ready": WARMUP_DONE.is_set(), **STARTUP_STATE }, "serving": { "worker": "gevent" if gevent_patched() else "threads", "rate_limit_storage": RATELIMIT_STORAGE_URI.split(':', 1)[0], "analysis_cache": type(analysis_cache.backend).__name__ } }), 200
+
+@app.route('/readyz', methods=['GET'])
+@limiter.exempt
+def readiness_probe():
+    ready = WARMUP_DONE.is_set()
+    return jsonify({ "ready": ready, **STARTUP_STATE }), 200 if ready else 503
 
 @app.route('/analyze', methods=['POST', 'OPTIONS'])
-@limiter.limit("5 per day")
-@cache.cached(key_prefix=lambda: request.get_data())
+@limiter.shared_limit("5 per day", scope="analyze")
 def analyze_company_text():
     if request.method == 'OPTIONS': return jsonify({'status': 'ok'}), 200
     if not API_KEYS_CONFIGURED: return make_error_response("configuration_error", "一个或多个必需的API密钥未在服务器上配置。", 503)
 
-    print("--- RAG analysis request received! ---")
+    log_event('analyze_request', "--- RAG analysis request received! ---")
     try:
-        data = request.get_json()
-        if not data: return make_error_response("invalid_json", "Request body is not valid JSON.", 400)
-
-        user_query = data.get('companyName')
-        if not user_query: return make_error_response("missing_parameter", "Company name is required.", 400)
+        analysis_request = parse_analysis_request(request.get_json(silent=True))
+        for event, payload in run_analysis_pipeline(analysis_request):
+            if event == 'result': return jsonify(payload)
+    except AnalysisError as e:
+        return make_error_response(e.error_type, e.message, e.status_code)
+    except Exception as e:
+        log_event('unhandled_error', f"!!! 发生未知错误(被主路由捕获): {e} !!!", level='error', exc_info=True)
+        return make_error_response("internal_server_error", "An unexpected error occurred. Please check server logs for details.", 500)
 
-        lang = data.get('lang', 'zh-CN')
-        if lang not in ['en', 'zh-CN', 'zh-TW']:
-            lang = 'zh-CN'
+@app.route('/analyze/stream', methods=['POST', 'OPTIONS'])
+@limiter.shared_limit("5 per day", scope="analyze")
+def analyze_company_text_stream():
+    """与 /analyze 相同的分析流程，但以 Server-Sent Events 实时推送阶段进度、来源和生成的报告片段。"""
+    if request.method == 'OPTIONS': return jsonify({'status': 'ok'}), 200
+    if not API_KEYS_CONFIGURED: return make_error_response("configuration_error", "一个或多个必需的API密钥未在服务器上配置。", 503)
 
-        # RAG Step 1: Query VectorDB
-        if PINECONE_INDEX:
-            try:
-                print(f"🔍 Performing RAG search in Pinecone for: '{user_query}'")
-                query_vector = genai.embed_content(model='models/text-embedding-004', content=user_query, task_type='RETRIEVAL_QUERY')['embedding']
-                
-                query_results = PINECONE_INDEX.query(
-                    vector=query_vector,
-                    top_k=5,
-                    include_metadata=True
-                )
-                
-                # Check if results are good enough (e.g., score > 0.5)
-                relevant_matches = [match for match in query_results['matches'] if match['score'] > 0.5]
-
-                if relevant_matches:
-                    print(f"✅ Found {len(relevant_matches)} relevant documents in Pinecone.")
-                    
-                    context_chunks = []
-                    sources_for_frontend = []
-                    for i, match in enumerate(relevant_matches, 1):
-                        metadata = match['metadata']
-                        snippet = metadata.get('snippet', '')
-                        context_chunks.append(f"[{i}] {snippet}")
-                        
-                        # Prepare sources for frontend
-                        label = "Unknown Source"
-                        if metadata.get('source_type') == 'web_scrape':
-                            try:
-                                domain = metadata['source_url'].split('/')[2]
-                                date = metadata['scraped_at'].split('T')[0]
-                                label = f"{domain} ({date})"
-                            except:
-                                label = "Web Scrape"
-                        else:
-                            label = metadata.get('label', f"Source {i}")
-
-                        
-                        sources_for_frontend.append({
-                            'id': i,
-                            'title': label,
-                            'link': metadata.get('source_url', '#'),
-                            'source_type': metadata.get('source_type', 'default'),
-                            'snippet': snippet
-                        })
-                    
-                    context_text = "\n\n".join(context_chunks)
-
-                    # RAG Step 2: Generate Answer from Context
-                    model = genai.GenerativeModel('models/gemini-2.5-pro')
-                    rag_prompt = PROMPTS[lang]['rag_prompt'].format(context_text=context_text, user_query=user_query)
-                    response = model.generate_content(rag_prompt)
-                    
-                    # RAG Step 3: Format Response
-                    answer = response.text
-
-                    return jsonify({
-                        "answer": answer,
-                        "sources": sources_for_frontend,
-                        "company_name": user_query
-                    })
+    log_event('analyze_stream_request', "--- RAG analysis stream request received! ---")
+    try:
+        analysis_request = parse_analysis_request(request.get_json(silent=True))
+    except AnalysisError as e:
+        return make_error_response(e.error_type, e.message, e.status_code)
 
-            except Exception as e:
-                print(f"❌ RAG search failed: {e}")
-                # Proceed to fallback logic
-        
-        print("⚠️ Pinecone RAG did not yield sufficient results. Falling back to web scraping.")
-        # Fallback logic (original implementation)
-        
-        try:
-            company_name, job_title, location = extract_entities_with_ai(user_query)
-        except Exception as e:
-            print(f"!!! 实体提取AI调用失败: {e} !!!"); print(traceback.format_exc())
-            error_message = f"AI entity extraction failed. Error: {type(e).__name__}. This might be a problem with the Generative Language API permissions or billing. Please ensure the model 'models/gemini-2.5-pro' is available for your project."
-            return make_error_response("ai_entity_extraction_error", error_message, 500)
-
-        if not company_name: return make_error_response("entity_extraction_failed", "Could not identify company name from input.", 400)
-
-        context_blocks, source_map, source_id_counter = [], {}, 1
-        location_query_part = f' "{location}"' if location else ""
-        comprehensive_queries = list(set([ f'"{company_name}"{location_query_part} {aspect}' for aspect in ["company culture review", "work life balance", "salary benefits", "growth opportunities", "hiring process interview", "management style", "overtime culture", "innovation culture", "diversity inclusion", "training programs", "sustainability", "scam fraud"] ] + [f'site:linkedin.com "{company_name}" "{location}"', f'site:indeed.com "{company_name}" "{location}" reviews', f'site:glassdoor.com "{company_name}" "{location}" reviews']))
-        
-        scraped_urls = set()
-        for query in comprehensive_queries:
-            print(f"🔍 正在处理综合查询: '{query}'") # New debug log
-            search_query = f'{query}'
-            snippets, sources_data = perform_google_search(search_query, SEARCH_API_KEY, SEARCH_ENGINE_ID)
-            print(f"✅ 综合查询结果: 查询='{query}', 找到 {len(snippets)} 个片段, {len(sources_data)} 个来源数据") # New debug log
-            for i, snippet in enumerate(snippets):
-                if i < len(sources_data):
-                    source_info = sources_data[i]
-                    link = source_info.get('link')
-                    if link and link not in scraped_urls:
-                        scraped_text = scrape_website_for_text(link)
-                        if scraped_text:
-                            context_blocks.append(f"[Source ID: {source_id_counter}] {scraped_text}")
-                            source_map[source_id_counter] = {
-                                'title': source_info.get('title'),
-                                'link': link,
-                                'snippet': snippet
-                            }
-                            source_id_counter += 1
-                            scraped_urls.add(link)
-            time.sleep(0.1)
-
-        if not context_blocks: return make_error_response("no_info_found", "No information found for this company. This might be due to the company being very new, very small, or the search query being too specific. Please try a broader search term.", 404)
-
-        full_prompt = PROMPTS[lang]['fallback_prompt'].format(company_name=company_name, job_title=job_title, location=location or "Not Specified", current_date=datetime.date.today().strftime("%Y-%m-%d"), resume_text=data.get('resumeText', 'No resume provided.'), context_with_sources="\n\n".join(context_blocks))
-        
+    def event_stream():
+        pipeline = run_analysis_pipeline(analysis_request, stream_tokens=True)
         try:
-            model = genai.GenerativeModel('models/gemini-2.5-pro')
-            safety_settings = { category: "BLOCK_NONE" for category in ["HARM_CATEGORY_HARASSMENT", "HARM_CATEGORY_HATE_SPEECH", "HARM_CATEGORY_SEXUALLY_EXPLICIT", "HARM_CATEGORY_DANGEROUS_CONTENT"]}
-            response = model.generate_content(full_prompt, generation_config=genai.GenerationConfig(response_mime_type="application/json"), safety_settings=safety_settings)
+            for event, payload in pipeline:
+                yield format_sse(event, payload)
+        except AnalysisError as e:
+            yield format_sse('error', {'error': e.error_type, 'message': e.message, 'status': e.status_code})
         except Exception as e:
-            print(f"!!! 核心分析AI调用失败: {e} !!!"); print(traceback.format_exc())
-            error_message = f"Main AI analysis call failed. Error: {type(e).__name__}. This could be due to API permissions, billing, or an issue with the content sent for analysis."
-            return make_error_response("ai_analysis_error", error_message, 500)
-        
-        if not response.parts: return make_error_response("ai_response_blocked", "AI content generation was blocked by safety settings.", 500)
+            log_event('unhandled_error', f"!!! 发生未知错误(被流式路由捕获): {e} !!!", level='error', exc_info=True)
+            yield format_sse('error', {'error': "internal_server_error", 'message': "An unexpected error occurred. Please check server logs for details.", 'status': 500})
+        finally:
+            # 客户端断开时 WSGI 服务器会关闭本生成器，这里同步关闭流水线以释放线程和上游连接
+            pipeline.close()
+
+    response = Response(stream_with_context(event_stream()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/analyze/jobs', methods=['POST', 'OPTIONS'])
+@limiter.shared_limit("5 per day", scope="analyze")
+def create_analysis_job():
+    """提交异步分析任务，立即返回任务 ID；通过 GET /analyze/jobs/<job_id> 轮询结果。"""
+    if request.method == 'OPTIONS': return jsonify({'status': 'ok'}), 200
+    if not API_KEYS_CONFIGURED: return make_error_response("configuration_error", "一个或多个必需的API密钥未在服务器上配置。", 503)
+    try:
+        analysis_request = parse_analysis_request(request.get_json(silent=True))
+    except AnalysisError as e:
+        return make_error_response(e.error_type, e.message, e.status_code)
+    job_id, coalesced = submit_analysis_job(analysis_request)
+    return jsonify({ 'job_id': job_id, 'status_url': f"/analyze/jobs/{job_id}", 'coalesced': coalesced }), 202
+
+@app.route('/analyze/batch', methods=['POST', 'OPTIONS'])
+@limiter.shared_limit("5 per day", scope="analyze", cost=batch_rate_limit_cost)
+def analyze_batch():
+    """批量分析：请求体为 JSON 数组、{"items": [...]} 或 NDJSON，每条记录完成后立即以一行 NDJSON 返回。"""
+    if request.method == 'OPTIONS': return jsonify({'status': 'ok'}), 200
+    if not API_KEYS_CONFIGURED: return make_error_response("configuration_error", "一个或多个必需的API密钥未在服务器上配置。", 503)
+    try:
+        records = parse_batch_records(request.get_data())
+    except AnalysisError as e:
+        return make_error_response(e.error_type, e.message, e.status_code)
 
+    def result_stream():
+        results = run_batch(records)
         try:
-            ai_json_response = json.loads(response.text)
-            report_data = ai_json_response.get("report", {})
-            
-            # --- RAG 修复逻辑 ---
-            all_mentioned_ids = extract_all_mentioned_ids(report_data)
-            valid_ids_set = all_mentioned_ids.intersection(source_map.keys())
-            scrubbed_report_data = scrub_invalid_citations(report_data, valid_ids_set)
-            # [最终修复] 将有效的 [ID] 标记转换为可点击的 Markdown 锚点链接
-            final_report_data = scrubbed_report_data
-
-        except json.JSONDecodeError:
-            print(f"!!! AI returned malformed JSON: {response.text} !!!") # Log the raw response
-            return make_error_response("ai_malformed_json", "AI failed to generate a valid JSON report.", 500)
-
-        final_sources = [ {**source_map[sid], 'id': sid} for sid in sorted(list(valid_ids_set)) if sid in source_map ]
-        return jsonify({"company_name": company_name, "answer": final_report_data, "sources": final_sources})
+            for item in results:
+                yield json.dumps(item, ensure_ascii=False) + "\n"
+        finally:
+            results.close()
 
-    except Exception as e:
-        print(f"!!! 发生未知错误(被主路由捕获): {e} !!!"); print(traceback.format_exc())
-        return make_error_response("internal_server_error", "An unexpected error occurred. Please check server logs for details.", 500)
+    response = Response(stream_with_context(result_stream()), mimetype='application/x-ndjson')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/analyze/jobs/<job_id>', methods=['GET'])
+@limiter.exempt
+def get_analysis_job_status(job_id):
+    job_status = get_analysis_job(job_id)
+    if job_status is None: return make_error_response("job_not_found", "Job not found or expired.", 404)
+    return jsonify(job_status), 200
+
+@app.route('/metrics', methods=['GET'])
+@limiter.exempt
+def metrics():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+# --- 10.1 命令行入口 ---
+@app.cli.command("analyze-batch")
+@click.argument("input_file", type=click.File("r", encoding="utf-8"), default="-")
+@click.option("--output", "-o", type=click.File("w", encoding="utf-8"), default="-", help="NDJSON 结果输出文件，默认标准输出。")
+@click.option("--concurrency", type=int, default=BATCH_CONCURRENCY, show_default=True, help="同时分析的记录数。")
+def analyze_batch_command(input_file, output, concurrency):
+    """批量分析 JSONL 文件 (每行一条记录，"-" 表示标准输入)，不受 BATCH_MAX_ITEMS 限制。"""
+    if not API_KEYS_CONFIGURED: raise click.ClickException("一个或多个必需的API密钥未配置。")
+    try:
+        records = parse_batch_records(input_file.read(), max_items=0)
+    except AnalysisError as e:
+        raise click.ClickException(e.message)
+    # 运行日志改写到标准错误，标准输出只保留 NDJSON 结果
+    with redirect_stdout(sys.stderr):
+        for item in run_batch(records, concurrency=max(1, concurrency)):
+            output.write(json.dumps(item, ensure_ascii=False) + "\n")
+            output.flush()
 
 # --- 11. 速率限制与全局错误处理器 ---
 @app.errorhandler(429)
 def ratelimit_handler(e):
-    print(f"Flask-Limiter rate limit triggered: {e.description}")
+    log_event('rate_limited', f"Flask-Limiter rate limit triggered: {e.description}", level='warning', description=str(e.description))
     message = get_rate_limit_message(request)
     return make_error_response("rate_limit_exceeded", message, 429)
 
 @app.errorhandler(500)
 def handle_internal_server_error(e):
-    print(f"!!! 全局500错误处理器被触发: {e} !!!")
-    print(traceback.format_exc())
+    log_event('internal_server_error', f"!!! 全局500错误处理器被触发: {e} !!!", level='error', exc_info=True)
     error_message = "An unexpected internal server error occurred. The development team has been notified."
     return make_error_response("internal_server_error", error_message, 500)
 
 
 # --- 12. 启动 ---
+start_warm_up()
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=int(os.environ.get("PORT", 8080)), debug=True)
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+# -----------------------------------------------------------------------------
+# 网页正文提取微基准 (HTML-to-text extraction micro-benchmark)
+# 用法: python benchmarks/bench_extract.py [--iterations 20] [--fixtures DIR]
+# 对比原先的 BeautifulSoup html.parser 实现与新的提取引擎 (app.extract_text)
+# 在 fixtures/html 语料上的吞吐量与峰值内存，并检查输出是否与原实现一致。
+# 每个实现都在独立子进程中运行，保证峰值 RSS 互不干扰。
+# -----------------------------------------------------------------------------
+
+import argparse
+import glob
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+DEFAULT_FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'html')
+
+
+def legacy_extract(content):
+    """原先 scrape_website_for_text 中的实现，原样保留作为对照组。"""
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(content, 'html.parser')
+    [s.decompose() for s in soup(['script', 'style'])]
+    return '\n'.join(chunk for chunk in (phrase.strip() for line in (line.strip() for line in soup.get_text().splitlines()) for phrase in line.split("  ")) if chunk)
+
+
+def _variants():
+    import app
+    return {
+        'legacy': legacy_extract,
+        'bs4': lambda c: app.extract_text(c, backend='bs4', remove_boilerplate=False, max_chars=0),
+        'lxml': lambda c: app.extract_text(c, backend='lxml', remove_boilerplate=False, max_chars=0),
+        'lxml+boilerplate': lambda c: app.extract_text(c, backend='lxml', remove_boilerplate=True, max_chars=0),
+        'lxml+boilerplate+early_exit': lambda c: app.extract_text(c, backend='lxml', remove_boilerplate=True),
+    }
+
+
+def _load_fixtures(directory):
+    fixtures = {}
+    for path in sorted(glob.glob(os.path.join(directory, '*.html'))):
+        with open(path, 'rb') as f:
+            fixtures[os.path.basename(path)] = f.read()
+    return fixtures
+
+
+def run_variant(name, directory, iterations):
+    """在当前进程中运行单个实现，返回吞吐量、峰值内存与各 fixture 的输出。"""
+    extract = _variants()[name]
+    fixtures = _load_fixtures(directory)
+    outputs = {fname: extract(content) for fname, content in fixtures.items()}  # 预热
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    tracemalloc.start()
+    started = time.perf_counter()
+    for _ in range(iterations):
+        for content in fixtures.values():
+            extract(content)
+    elapsed = time.perf_counter() - started
+    _, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    pages = iterations * len(fixtures)
+    total_bytes = iterations * sum(len(c) for c in fixtures.values())
+    return {
+        'variant': name,
+        'pages_per_sec': pages / elapsed,
+        'mb_per_sec': total_bytes / elapsed / 1e6,
+        'ms_per_page': elapsed / pages * 1000,
+        'traced_peak_kb': traced_peak / 1024,
+        'rss_growth_kb': max(0, rss_after - rss_before),
+        'rss_peak_kb': rss_after,
+        'outputs': outputs,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='HTML-to-text extraction micro-benchmark')
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--fixtures', default=DEFAULT_FIXTURES)
+    parser.add_argument('--variant', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.variant:
+        print(json.dumps(run_variant(args.variant, args.fixtures, args.iterations)))
+        return
+
+    results = []
+    for name in ['legacy', 'bs4', 'lxml', 'lxml+boilerplate', 'lxml+boilerplate+early_exit']:
+        proc = subprocess.run([sys.executable, __file__, '--variant', name, '--fixtures', args.fixtures, '--iterations', str(args.iterations)],
+                              capture_output=True, text=True, check=True)
+        results.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+
+    legacy = results[0]
+    print(f"\n语料: {len(legacy['outputs'])} 个 fixture, 每个实现迭代 {args.iterations} 轮\n")
+    print(f"{'variant':<30}{'pages/s':>10}{'MB/s':>8}{'ms/page':>9}{'speedup':>9}{'py peak KB':>12}{'RSS peak KB':>13}  output vs legacy")
+    legacy_chars = sum(len(o) for o in legacy['outputs'].values())
+    for r in results:
+        if all(r['outputs'][f] == legacy['outputs'][f] for f in legacy['outputs']):
+            comparison = 'identical'
+        else:
+            comparison = f"{sum(len(o) for o in r['outputs'].values()) / legacy_chars:.0%} of legacy text"
+        print(f"{r['variant']:<30}{r['pages_per_sec']:>10.1f}{r['mb_per_sec']:>8.2f}{r['ms_per_page']:>9.2f}"
+              f"{r['pages_per_sec'] / legacy['pages_per_sec']:>8.1f}x{r['traced_peak_kb']:>12.0f}{r['rss_peak_kb']:>13}  {comparison}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+# -----------------------------------------------------------------------------
+# 离线压测替身 (offline stand-ins for Gemini, Custom Search, Pinecone and target sites)
+# install(app) 把 app 的外部依赖替换为本地实现，返回值按预设的延迟分布 (对数正态，
+# 由中位数和 p95 确定) 休眠后给出，请求带超时时按真实客户端的方式抛出超时异常：
+#   - genai.GenerativeModel / genai.embed_content: 按 Prompt 类型返回实体 JSON、RAG 回答或报告 JSON
+#   - Custom Search 与网页: 挂在 requests 上的传输适配器，网页正文来自 fixtures/html 语料
+#   - PINECONE_INDEX: 以 app.LocalVectorIndex 为存储、带网络延迟的索引
+# 所有替身只在 benchmarks 进程内生效，不会发出任何网络请求。
+# -----------------------------------------------------------------------------
+
+import glob
+import hashlib
+import io
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.response import HTTPResponse
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'html')
+FIXTURE_COMPANY = b'Acme Corp'
+CORPUS_HOSTS = ['www.glassdoor.com', 'www.indeed.com', 'www.linkedin.com', 'news.example.com', 'blog.example.org', 'forum.example.net']
+EMBEDDING_DIM = 768
+
+# 各外部调用的延迟分布 (毫秒)：(中位数, p95)。量级取自生产环境的常见观测值。
+LATENCY_PROFILE = {
+    'entity_model': (700, 1800),
+    'generation': (9000, 25000),
+    'embedding': (150, 400),
+    'search': (350, 900),
+    'page': (400, 2500),
+    'pinecone_query': (60, 200),
+    'pinecone_upsert': (80, 300),
+}
+NON_HTML_RATE = 0.05  # 搜索结果中指向 PDF 等非 HTML 内容的比例
+
+
+class Latency:
+    """对数正态延迟分布，scale 用于整体缩短压测时长 (所有调用同比例缩放)。"""
+
+    def __init__(self, median_ms, p95_ms, scale=1.0, rng=None):
+        self.mu = math.log(median_ms / 1000 * scale)
+        self.sigma = math.log(p95_ms / median_ms) / 1.645
+        self.rng = rng or random.Random()
+        self._lock = threading.Lock()
+
+    def sample(self):
+        with self._lock:
+            return math.exp(self.rng.gauss(self.mu, self.sigma))
+
+    def wait(self, timeout=None, on_timeout=None):
+        """休眠一个样本的时长；超过 timeout 时只休眠到 timeout 并抛出 on_timeout。"""
+        delay = self.sample()
+        if timeout is not None and delay > timeout:
+            time.sleep(timeout)
+            raise on_timeout
+        time.sleep(delay)
+
+
+def _timeout_seconds(timeout):
+    if isinstance(timeout, tuple): return timeout[1]
+    return timeout
+
+
+# --- Gemini ---
+class FakePart:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+        self.parts = [FakePart(text)] if text else []
+        self.prompt_feedback = None
+
+
+class FakeGenai:
+    """genai.GenerativeModel 与 genai.embed_content 的替身。超时异常与应用选用的传输一致：
+    gRPC 抛出 DeadlineExceeded，REST (gevent 下的默认传输) 抛出 requests 的 ReadTimeout。"""
+
+    def __init__(self, latencies, transport='grpc'):
+        self.latencies = latencies
+        self.transport = transport
+        fakes = self
+
+        class GenerativeModel:
+            def __init__(self, model_name, *args, **kwargs):
+                self.model_name = model_name
+
+            def generate_content(self, prompt, stream=False, request_options=None, **kwargs):
+                return fakes.generate(self.model_name, prompt, stream, request_options)
+
+        self.GenerativeModel = GenerativeModel
+
+    def _timeout_error(self, model_name, timeout):
+        if self.transport == 'rest': return requests.exceptions.ReadTimeout(f"{model_name} did not respond within {timeout}s")
+        from google.api_core import exceptions as google_exceptions
+        return google_exceptions.DeadlineExceeded(f"{model_name} did not respond within {timeout}s")
+
+    def generate(self, model_name, prompt, stream, request_options):
+        timeout = (request_options or {}).get('timeout')
+        kind = 'entity_model' if 'extract the company name' in prompt else 'generation'
+        self.latencies[kind].wait(timeout, self._timeout_error(model_name, timeout))
+        if kind == 'entity_model':
+            text = self._entities(prompt)
+        elif '[Source ID:' in prompt:
+            text = self._report(prompt)
+        else:
+            text = "Based on the indexed sources, employees describe a fast-paced culture with flexible hybrid work [1]. Compensation is competitive [2]."
+        if not stream: return FakeResponse(text)
+        return iter([FakeResponse(text[i:i + 40]) for i in range(0, len(text), 40)])
+
+    @staticmethod
+    def _entities(prompt):
+        blob = prompt.split('---')[1].strip()
+        company = re.search(r'Benchmark Co \d+', blob)
+        location = re.search(r'\bin ([A-Z][a-z]+)', blob)
+        return json.dumps({
+            'company_name': company.group(0) if company else blob.split(',')[0].strip(),
+            'job_title': 'Software Engineer' if re.search(r'engineer', blob, re.I) else '',
+            'location': location.group(1) if location else '',
+            'confidence': 0.9,
+        })
+
+    @staticmethod
+    def _report(prompt):
+        ids = [int(i) for i in re.findall(r'\[Source ID: (\d+)\]', prompt)][:4] or [1]
+        cite = lambda k: f"[{ids[k % len(ids)]}]"
+        report = {
+            'company_location': '',
+            'red_flag_status': 'Low Risk',
+            'red_flag_text': f"No recurring complaints about layoffs or unpaid wages {cite(0)}, {cite(1)}.",
+            'hiring_experience_text': f"Candidates report a four-stage process with a take-home task {cite(1)}.",
+            'timeliness_analysis': f"1. Most sources are from the last year {cite(2)}. 2. Likely open {cite(0)}.",
+            'culture_fit': {aspect: f"Mixed feedback {cite(i)}." for i, aspect in enumerate(['reputation', 'management', 'sustainability', 'wlb', 'growth', 'salary', 'overtime', 'innovation', 'benefits', 'diversity', 'training'])},
+            'value_match_score': '70',
+            'value_match_text': f"The resume matches the core stack {cite(3)}.",
+            'final_risk_rating': 'Low',
+            'final_risk_text': f"Overall a stable employer {cite(0)}.",
+        }
+        return json.dumps({'report': report, 'cited_ids': ids})
+
+    def embed_content(self, model, content, task_type=None, request_options=None, **kwargs):
+        timeout = (request_options or {}).get('timeout')
+        self.latencies['embedding'].wait(timeout, self._timeout_error(model, timeout))
+        if isinstance(content, list): return {'embedding': [fake_embedding(text) for text in content]}
+        return {'embedding': fake_embedding(content)}
+
+
+_BIAS = [random.Random(0).uniform(-1, 1) for _ in range(EMBEDDING_DIM)]
+
+def fake_embedding(text):
+    """哈希词袋 + 公共分量：同一公司的文档块与查询的相似度稳定高于 RAG_MIN_SCORE。"""
+    vector = [2 * b for b in _BIAS]
+    for word in re.findall(r'\w+', text.lower()):
+        vector[int(hashlib.md5(word.encode('utf-8')).hexdigest(), 16) % EMBEDDING_DIM] += 1.0
+    norm = math.sqrt(sum(v * v for v in vector))
+    return [v / norm for v in vector]
+
+
+# --- Custom Search 与目标网站 ---
+def load_corpus(directory=FIXTURES_DIR):
+    corpus = []
+    for path in sorted(glob.glob(os.path.join(directory, '*.html'))):
+        with open(path, 'rb') as f:
+            corpus.append(f.read())
+    return corpus
+
+
+class FakeWebAdapter(HTTPAdapter):
+    """requests 传输适配器：googleapis.com 返回 Custom Search JSON，其余主机返回语料中的网页。"""
+
+    def __init__(self, latencies, corpus, rng=None):
+        super().__init__()
+        self.latencies = latencies
+        self.corpus = corpus
+        self.rng = rng or random.Random()
+        self._lock = threading.Lock()
+
+    def send(self, request, stream=False, timeout=None, **kwargs):
+        url = urlparse(request.url)
+        timeout = _timeout_seconds(timeout)
+        if url.hostname == 'www.googleapis.com':
+            self.latencies['search'].wait(timeout, requests.exceptions.ReadTimeout(f"Custom Search timed out after {timeout}s"))
+            status, content_type, body = 200, 'application/json; charset=UTF-8', self._search(parse_qs(url.query))
+        else:
+            self.latencies['page'].wait(timeout, requests.exceptions.ReadTimeout(f"{url.hostname} timed out after {timeout}s"))
+            status, content_type, body = 200, 'text/html; charset=utf-8', self._page(url)
+            if url.path.endswith('.pdf'): content_type, body = 'application/pdf', b'%PDF-1.4 ' + b'0' * 4096
+        raw = HTTPResponse(body=io.BytesIO(body), headers={'Content-Type': content_type, 'Content-Length': str(len(body))}, status=status, preload_content=False, decode_content=False)
+        return self.build_response(request, raw)
+
+    def _search(self, params):
+        query, num = params.get('q', [''])[0], int(params.get('num', ['2'])[0])
+        company = re.search(r'Benchmark Co \d+', query)
+        slug = re.sub(r'\W+', '-', company.group(0) if company else query).strip('-').lower()
+        digest = int(hashlib.md5(query.encode('utf-8')).hexdigest(), 16)
+        items = []
+        with self._lock:
+            pdf = [self.rng.random() < NON_HTML_RATE for _ in range(num)]
+        for i in range(num):
+            host = CORPUS_HOSTS[(digest + i) % len(CORPUS_HOSTS)]
+            suffix = '.pdf' if pdf[i] else ''
+            items.append({'title': f"{company.group(0) if company else query} on {host}", 'link': f"https://{host}/{slug}/{(digest >> 8) % 997}-{i}{suffix}", 'snippet': f"Reviews, salaries and interview questions for {company.group(0) if company else query}."})
+        return json.dumps({'items': items}).encode('utf-8')
+
+    def _page(self, url):
+        page = self.corpus[int(hashlib.md5(url.path.encode('utf-8')).hexdigest(), 16) % len(self.corpus)]
+        company = re.sub(r'-(\d+)$', r' \1', url.path.split('/')[1]).replace('-', ' ').title().encode('utf-8')
+        return page.replace(FIXTURE_COMPANY, company)
+
+
+# --- Pinecone ---
+class FakePineconeIndex:
+    """以 LocalVectorIndex 为存储的 Pinecone 替身，query / upsert 额外附加网络延迟。"""
+
+    def __init__(self, store, latencies):
+        self.store = store
+        self.latencies = latencies
+
+    def upsert(self, vectors):
+        self.latencies['pinecone_upsert'].wait()
+        self.store.upsert(vectors)
+        return {'upserted_count': len(vectors)}
+
+    def query(self, vector, top_k, include_metadata=True, filter=None):
+        self.latencies['pinecone_query'].wait()
+        return self.store.query(vector=vector, top_k=top_k, filter=filter)
+
+
+def build_latencies(scale=1.0, seed=0, profile=None):
+    profile = {**LATENCY_PROFILE, **(profile or {})}
+    return {name: Latency(median, p95, scale, random.Random(f"{seed}-{name}")) for name, (median, p95) in profile.items()}
+
+
+def install(app_module, scale=1.0, seed=0, pinecone=True):
+    """替换 app_module 的外部依赖，返回 (latencies, pinecone_index)。"""
+    latencies = build_latencies(scale, seed)
+    genai = FakeGenai(latencies, app_module.GENAI_TRANSPORT or ('rest' if app_module.gevent_patched() else 'grpc'))
+    # 启动预热会缓存真实的 GenerativeModel 实例，等预热结束后替换并清空缓存
+    app_module.WARMUP_DONE.wait()
+    app_module.genai.GenerativeModel = genai.GenerativeModel
+    app_module.genai.embed_content = genai.embed_content
+    app_module.MODEL_CACHE.clear()
+
+    adapter = FakeWebAdapter(latencies, load_corpus(), random.Random(seed))
+    app_module.HTTP_SESSION.mount('http://', adapter)
+    app_module.HTTP_SESSION.mount('https://', adapter)
+    # Custom Search 通过模块级 requests.get 发出，这里换成挂载了同一适配器的会话
+    search_session = requests.Session()
+    search_session.mount('https://', adapter)
+    requests.get = search_session.get
+
+    pinecone_index = FakePineconeIndex(app_module.LocalVectorIndex(app_module.LOCAL_INDEX_CAPACITY or 20000), latencies) if pinecone else None
+    app_module.PINECONE_INDEX = pinecone_index
+    app_module.API_KEYS_CONFIGURED = True
+    app_module.limiter.enabled = False
+    return latencies, pinecone_index
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+# -----------------------------------------------------------------------------
+# /analyze 离线压测 (offline load generator for /analyze)
+# 用法: python benchmarks/loadgen.py [--paths rag fallback] [--requests 40] [--concurrency 8]
+#       python benchmarks/loadgen.py --save-baseline   # 写入 benchmarks/baseline.json
+#       python benchmarks/loadgen.py --compare         # 与 baseline.json 对比，出现退化时退出码为 1
+# 外部依赖全部由 benchmarks/fakes.py 的替身提供 (不消耗任何 API 配额)。每条路径在独立子进程中
+# 运行，按目标并发通过 Flask 测试客户端调用 /analyze，统计 p50/p95/p99 延迟、RPS 和峰值 RSS：
+#   - rag:      预先向向量索引写入每家公司的文档块，请求走 RAG 路径
+#   - fallback: 索引为空，请求走搜索 + 爬取 + 生成的后备路径
+# 每个请求使用不同的公司名，分析缓存不会命中。替身延迟按 --latency-scale 同比例缩放。
+# -----------------------------------------------------------------------------
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+PATHS = ('rag', 'fallback')
+WARMUP_REQUESTS = 2
+# 对比基线时的指标方向：1 表示越大越好，-1 表示越小越好
+COMPARED_METRICS = {'p50_ms': -1, 'p95_ms': -1, 'p99_ms': -1, 'rps': 1, 'peak_rss_kb': -1}
+
+BENCHMARK_ENV = {
+    'GEMINI_API_KEY': 'benchmark', 'SEARCH_API_KEY': 'benchmark', 'SEARCH_ENGINE_ID': 'benchmark',
+    'ANALYSIS_CACHE_BACKEND': 'memory', 'CSE_DAILY_QUOTA': '0', 'LOCAL_INDEX_PATH': '', 'LOG_FORMAT': 'text',
+}
+
+
+def company_name(i):
+    return f"Benchmark Co {i:04d}"
+
+
+def build_query(i):
+    """三分之一的请求是自由文本 (交给快速模型提取实体)，其余是规则层能直接解析的格式。"""
+    if i % 3 == 0:
+        return f"Thinking about joining {company_name(i)} as a backend engineer in Austin, any red flags?"
+    return f"Software Engineer at {company_name(i)}, Austin"
+
+
+def seed_index(app, index, count):
+    """为 rag 路径预先写入每家公司的 5 个文档块。"""
+    from fakes import fake_embedding
+    scraped_at = datetime.datetime.utcnow().isoformat()
+    for i in range(count):
+        company = company_name(i)
+        vectors = []
+        for chunk in range(5):
+            snippet = f"{company} employees describe the culture, management and work-life balance (review {chunk})."
+            vectors.append({
+                'id': f"seed-{i}-{chunk}",
+                'values': fake_embedding(snippet),
+                'metadata': {'source_type': 'web_scrape', 'source_url': f"https://www.glassdoor.com/{i}/{chunk}", 'snippet': snippet, 'chunk_index': chunk,
+                             'company': app.normalize_company_name(company), 'lang': 'en', 'scraped_at': scraped_at},
+            })
+        index.upsert(vectors)
+
+
+def percentile(sorted_values, q):
+    if not sorted_values: return None
+    rank = max(0, min(len(sorted_values) - 1, int(round(q / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[rank]
+
+
+def run_path(path, requests_count, concurrency, latency_scale, seed, index):
+    """在当前进程中压测一条路径。必须在导入 app 之前设置好环境变量。"""
+    os.environ.update(BENCHMARK_ENV)
+    os.environ.pop('PINECONE_API_KEY', None)
+    if index == 'pinecone': os.environ['LOCAL_INDEX_CAPACITY'] = '0'
+    import app
+    import fakes
+    _, pinecone_index = fakes.install(app, scale=latency_scale, seed=seed, pinecone=index in ('pinecone', 'both'))
+
+    total = WARMUP_REQUESTS + requests_count
+    if path == 'rag':
+        for target in (app.LOCAL_VECTOR_INDEX, pinecone_index.store if pinecone_index else None):
+            if target is not None: seed_index(app, target, total)
+
+    local = threading.local()
+    def analyze(i):
+        if not hasattr(local, 'client'): local.client = app.app.test_client()
+        started = time.perf_counter()
+        response = local.client.post('/analyze', json={'companyName': build_query(i), 'lang': 'en', 'resumeText': 'Backend engineer, 6 years of Python and Go.'})
+        return time.perf_counter() - started, response.status_code
+
+    for i in range(WARMUP_REQUESTS): analyze(i)
+    served_before = {served: app.ANALYSES_TOTAL.total(path=served) for served in ('cache', 'rag', 'fallback', 'none')}
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        outcomes = list(executor.map(analyze, range(WARMUP_REQUESTS, total)))
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(latency for latency, status in outcomes if status == 200)
+    return {
+        'path': path,
+        'requests': requests_count,
+        'concurrency': concurrency,
+        'errors': sum(1 for _, status in outcomes if status != 200),
+        'served_by': {served: app.ANALYSES_TOTAL.total(path=served) - count for served, count in served_before.items() if app.ANALYSES_TOTAL.total(path=served) > count},
+        'p50_ms': percentile(latencies, 50) * 1000 if latencies else None,
+        'p95_ms': percentile(latencies, 95) * 1000 if latencies else None,
+        'p99_ms': percentile(latencies, 99) * 1000 if latencies else None,
+        'rps': len(latencies) / elapsed,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def run_all(paths, args):
+    results = {}
+    for path in paths:
+        with tempfile.NamedTemporaryFile(suffix='.json') as output:
+            command = [sys.executable, __file__, '--worker-path', path, '--worker-output', output.name, '--requests', str(args.requests),
+                       '--concurrency', str(args.concurrency), '--latency-scale', str(args.latency_scale), '--seed', str(args.seed), '--index', args.index]
+            subprocess.run(command, check=True, stdout=None if args.verbose else subprocess.DEVNULL, stderr=None if args.verbose else subprocess.DEVNULL)
+            with open(output.name, encoding='utf-8') as f:
+                results[path] = json.load(f)
+    return results
+
+
+def _fmt(value, digits=1):
+    return '-' if value is None else f"{value:.{digits}f}"
+
+
+def print_results(results):
+    print(f"{'path':<10}{'reqs':>6}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/s':>8}{'RSS peak KB':>13}  served by")
+    for r in results.values():
+        served_by = ', '.join(f"{key}={value}" for key, value in sorted(r['served_by'].items()))
+        print(f"{r['path']:<10}{r['requests']:>6}{r['errors']:>8}{_fmt(r['p50_ms']):>10}{_fmt(r['p95_ms']):>10}{_fmt(r['p99_ms']):>10}{_fmt(r['rps'], 2):>8}{r['peak_rss_kb']:>13}  {served_by}")
+
+
+def compare(results, baseline, tolerance):
+    """打印与基线的差异，返回退化的指标列表。"""
+    regressions = []
+    print(f"\n对比基线 ({baseline['recorded_at']}, 容差 {tolerance:.0%})\n")
+    print(f"{'path':<10}{'metric':<14}{'baseline':>12}{'current':>12}{'change':>9}")
+    for path, current in results.items():
+        previous = baseline['results'].get(path)
+        if not previous: continue
+        for metric, direction in COMPARED_METRICS.items():
+            if previous.get(metric) is None or current.get(metric) is None: continue
+            change = (current[metric] - previous[metric]) / previous[metric] if previous[metric] else 0.0
+            regressed = change * direction < -tolerance
+            if regressed: regressions.append(f"{path}.{metric}")
+            print(f"{path:<10}{metric:<14}{previous[metric]:>12.1f}{current[metric]:>12.1f}{change:>+9.1%}{'  REGRESSION' if regressed else ''}")
+        if current['errors'] > previous.get('errors', 0):
+            regressions.append(f"{path}.errors")
+            print(f"{path:<10}{'errors':<14}{previous.get('errors', 0):>12}{current['errors']:>12}{'':>9}  REGRESSION")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline load generator for /analyze')
+    parser.add_argument('--paths', nargs='+', choices=PATHS, default=list(PATHS))
+    parser.add_argument('--requests', type=int, default=40, help='每条路径计时的请求数 (另有预热请求)')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--latency-scale', type=float, default=0.05, help='替身延迟的缩放比例，1.0 为接近生产的延迟')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--index', choices=['local', 'pinecone', 'both'], default='both', help='RAG 路径使用的向量索引')
+    parser.add_argument('--save-baseline', action='store_true', help=f'把结果写入 {os.path.relpath(BASELINE_PATH, ROOT)}')
+    parser.add_argument('--compare', action='store_true', help='按基线记录的参数运行并对比')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='对比时允许的相对退化')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--verbose', action='store_true', help='显示子进程中应用的日志')
+    parser.add_argument('--worker-path', help=argparse.SUPPRESS)
+    parser.add_argument('--worker-output', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker_path:
+        # 应用日志写到标准错误，结果写到父进程指定的文件
+        with redirect_stdout(sys.stderr):
+            result = run_path(args.worker_path, args.requests, args.concurrency, args.latency_scale, args.seed, args.index)
+        with open(args.worker_output, 'w', encoding='utf-8') as f:
+            json.dump(result, f)
+        os._exit(0)  # 不等待后台索引线程刷完队列
+
+    baseline = None
+    if args.compare:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        for key, value in baseline['config'].items():
+            setattr(args, key, value)
+
+    config = {'requests': args.requests, 'concurrency': args.concurrency, 'latency_scale': args.latency_scale, 'seed': args.seed, 'index': args.index}
+    print(f"\n压测配置: {json.dumps(config)}\n")
+    results = run_all(args.paths, args)
+    print_results(results)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump({'recorded_at': datetime.datetime.utcnow().isoformat(timespec='seconds') + 'Z', 'python': platform.python_version(), 'machine': platform.machine(),
+                       'cpus': os.cpu_count(), 'config': config, 'results': results}, f, indent=2, ensure_ascii=False)
+            f.write('\n')
+        print(f"\n基线已写入 {args.baseline}")
+    if baseline:
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"\n性能退化: {', '.join(regressions)}")
+            sys.exit(1)
+        print("\n未发现超出容差的退化。")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+# -----------------------------------------------------------------------------
+# 「职场透镜」Gunicorn 配置 (Project Lens Gunicorn Config)
+# 描述: 监听地址与超时见 Dockerfile。Worker 相关参数由环境变量控制：
+#       - GUNICORN_WORKER_CLASS=gevent (Dockerfile 默认): 每个 Worker 用协程处理请求，
+#         分析过程中等待搜索、爬取、Gemini 和 Pinecone 响应时不占用系统线程，
+#         单个 Worker 可以同时处理 GUNICORN_WORKER_CONNECTIONS 个请求。
+#       - GUNICORN_WORKER_CLASS=gthread: 原先的线程模式，每个 Worker GUNICORN_THREADS 个线程。
+#       WEB_CONCURRENCY 大于 1 (或多实例部署) 时应设置 REDIS_URL，让速率限制、分析缓存和搜索配额跨进程共享。
+# -----------------------------------------------------------------------------
+import os
+
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "500"))
+
+def worker_exit(server, worker):
+    # Worker 退出前把后台索引队列中剩余的网页写入 Pinecone，避免已爬取的数据丢失；最后写出缓冲中的日志
+    from app import flush_logs, shutdown_indexer
+    shutdown_indexer()
+    flush_logs()
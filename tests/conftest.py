@@ -0,0 +1,7 @@
+import os
+import sys
+
+# 测试不访问任何外部服务：分析缓存留在进程内，本地向量索引不落盘
+os.environ.setdefault("ANALYSIS_CACHE_BACKEND", "memory")
+os.environ.setdefault("LOCAL_INDEX_PATH", "")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,34 @@
+import pytest
+
+from app import ENTITY_CONFIDENCE_THRESHOLD, parse_entities_with_rules
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("Company: Acme Corp\nPosition: Backend Engineer\nLocation: Berlin", ("Acme Corp", "Backend Engineer", "Berlin", 0.95)),
+    ("Senior Software Engineer at Acme Corp, Berlin", ("Acme Corp", "Senior Software Engineer", "Berlin", 0.9)),
+    ("Engineer @ Acme (Remote)", ("Acme", "Engineer", "Remote", 0.9)),
+    ("Manager at McDonald's in Chicago", ("McDonald's", "Manager", "Chicago", 0.9)),
+    ("Manager at Acme in Berlin, Germany", ("Acme", "Manager", "Berlin, Germany", 0.9)),
+    ("Tesla", ("Tesla", "", "", 0.85)),
+    ("Acme Corp", ("Acme Corp", "", "", 0.85)),
+])
+def test_confident_rules(text, expected):
+    assert parse_entities_with_rules(text) == expected
+
+
+@pytest.mark.parametrize("text", [
+    "What is it like to be a software engineer at Google?",
+    "Is the lead engineer at Tesla good?",
+    "red flags for Tesla",
+    "is Tesla good",
+    "特斯拉怎么样",
+    "Software Engineer at acme corp, austin",
+])
+def test_questions_and_sentences_are_left_to_the_models(text):
+    assert parse_entities_with_rules(text) is None
+
+
+def test_multi_word_name_without_suffix_needs_model_confirmation():
+    company, _, _, confidence = parse_entities_with_rules("Tesla Berlin")
+    assert company == "Tesla Berlin"
+    assert confidence < ENTITY_CONFIDENCE_THRESHOLD